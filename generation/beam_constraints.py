@@ -1,5 +1,27 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Union
+
+import torch
+
+
+class _Wildcard:
+    """
+    Sentinel returned by [`Constraint.advance`] when any token of the vocabulary makes progress, so that callers don't
+    have to enumerate the whole vocabulary.
+    """
+
+    def __repr__(self):
+        return "WILDCARD"
+
+
+WILDCARD = _Wildcard()
+
+# keys (see `Constraint.validation_key`) of the most recently built constraints that passed `Constraint.test`
+_validated_constraints = OrderedDict()
+_MAX_VALIDATED_CONSTRAINTS = 65536
 
 
 class Constraint(ABC):
@@ -17,9 +39,31 @@ class Constraint(ABC):
     will always terminate (halt).
     """
 
+    # subclasses may declare `__slots__` for the progress they track, see [`ConstraintSpec`]
+    __slots__ = ()
+
     def __init__(self):
-        # test for the above condition
-        self.test()
+        # test for the above condition, only once for every distinct constraint
+        key = self.validation_key()
+        if key is None or key not in _validated_constraints:
+            self.test()
+            if key is not None:
+                _validated_constraints[key] = True
+                if len(_validated_constraints) > _MAX_VALIDATED_CONSTRAINTS:
+                    _validated_constraints.popitem(last=False)
+        else:
+            _validated_constraints.move_to_end(key)
+
+    def validation_key(self):
+        """
+        Returns a hashable key such that constraints with equal keys pass or fail [`~Constraint.test`] alike, so that
+        it only runs once for all of them, or `None` to always run it. By default, constraints built from a
+        [`ConstraintSpec`] are keyed by their class and content.
+        """
+        spec = getattr(self, "spec", None)
+        if not isinstance(spec, ConstraintSpec):
+            return None
+        return (type(self), spec.key)
 
     def test(self):
         """
@@ -31,6 +75,9 @@ class Constraint(ABC):
             if counter == 1:
                 self.reset()
             advance = self.advance()
+            if advance is WILDCARD:
+                # any token makes progress, so the first one of the vocabulary is as good as any other
+                advance = 0
             if not self.does_advance(advance):
                 raise Exception(
                     "Custom Constraint is not defined correctly. self.does_advance(self.advance()) must be true."
@@ -45,6 +92,9 @@ class Constraint(ABC):
         if self.remaining() != 0:
             raise Exception("Custom Constraint is not defined correctly.")
 
+        # the simulation above leaves the constraint fulfilled, hand it back in its initial state
+        self.reset()
+
     @abstractmethod
     def advance(self):
         """
@@ -54,6 +104,7 @@ class Constraint(ABC):
             token_ids (Union[int, List[int], None]):
                 - A single token ID (int) that advances the constraint, or
                 - A list of token IDs that could advance the constraint
+                - `WILDCARD` if any token of the vocabulary advances the constraint
                 - None if the constraint is completed or cannot be advanced
         """
         raise NotImplementedError(
@@ -113,6 +164,14 @@ class Constraint(ABC):
             f"{self.__class__} is an abstract class. Only classes inheriting this class can be called."
         )
 
+    def min_remaining(self):
+        """
+        Returns the least number of tokens that can complete this constraint, so that a beam that has fewer tokens left
+        to generate can never fulfill it. Defaults to `remaining()`, which constraints that can be completed in several
+        ways should refine.
+        """
+        return self.remaining()
+
     @abstractmethod
     def copy(self, stateful=False):
         """
@@ -128,6 +187,67 @@ class Constraint(ABC):
             f"{self.__class__} is an abstract class. Only classes inheriting this class can be called."
         )
 
+    def tracked_token_ids(self):
+        """
+        Returns the token ids this constraint reacts to. Every token outside of this list must have the same effect on
+        the constraint. Optional, only needed to compile the constraint into a [`ConstraintDFA`].
+        """
+        raise NotImplementedError(f"{self.__class__} can't be compiled into a `ConstraintDFA`.")
+
+    def state_key(self):
+        """
+        Returns a hashable snapshot of this constraint and of its progress: two constraints with the same key must
+        behave the same on every future token. Optional, only needed to compile the constraint into a
+        [`ConstraintDFA`].
+        """
+        raise NotImplementedError(f"{self.__class__} can't be compiled into a `ConstraintDFA`.")
+
+    def num_states(self):
+        """
+        Returns an upper bound on the number of distinct `state_key()`s of this constraint and its copies, so that the
+        size of a [`ConstraintDFA`] can be estimated without building it. Optional, only needed for
+        [`ConstrainedBeamSearchScorer`] to compile the constraint.
+        """
+        raise NotImplementedError(f"{self.__class__} can't be compiled into a `ConstraintDFA`.")
+
+
+class ConstraintSpec:
+    r"""
+    The immutable description of a [`Constraint`], validated once and shared by all of its copies, so that copying a
+    constraint only copies the few integers tracking its progress.
+
+    Args:
+        token_ids (`list`):
+            The tokens describing the constraint, e.g. a phrase or a template. It must not be modified afterwards.
+        vocab_length (`int`, *optional*):
+            The size of the vocabulary the constraint is used with.
+    """
+
+    __slots__ = ("token_ids", "key", "seqlen", "vocab_length")
+
+    def __init__(self, token_ids: list, vocab_length: Optional[int] = None):
+        object.__setattr__(self, "token_ids", token_ids)
+        # hashable copy of `token_ids`, identifying the constraint in `state_key`
+        object.__setattr__(self, "key", tuple(token_ids))
+        object.__setattr__(self, "seqlen", len(token_ids))
+        object.__setattr__(self, "vocab_length", vocab_length)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable.")
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        # immutable, so copies of a constraint (e.g. in a deep-copied `GenerationConfig`) can keep sharing it
+        return self
+
+    def __setstate__(self, state):
+        # unpickling would otherwise restore the slots through `__setattr__`
+        _, slots = state
+        for name, value in slots.items():
+            object.__setattr__(self, name, value)
+
 
 class PhrasalConstraint(Constraint):
     r"""
@@ -138,6 +258,8 @@ class PhrasalConstraint(Constraint):
             The id of the token that must be generated by the output.
     """
 
+    __slots__ = ("spec", "fulfilled_idx", "completed")
+
     def __init__(self, token_ids: List[int]):
         super(Constraint, self).__init__()
 
@@ -146,12 +268,18 @@ class PhrasalConstraint(Constraint):
         if any((not isinstance(token_id, int) or token_id < 0) for token_id in token_ids):
             raise ValueError(f"Each list in `token_ids` has to be a list of positive integers, but is {token_ids}.")
 
-        self.token_ids = token_ids
-
-        self.seqlen = len(self.token_ids)
+        self.spec = ConstraintSpec(token_ids)
         self.fulfilled_idx = -1  # the index of the currently fulfilled step
         self.completed = False
 
+    @property
+    def token_ids(self):
+        return self.spec.token_ids
+
+    @property
+    def seqlen(self):
+        return self.spec.seqlen
+
     def advance(self):
         if self.completed:
             return None
@@ -193,22 +321,37 @@ class PhrasalConstraint(Constraint):
     def remaining(self):
         return self.seqlen - (self.fulfilled_idx + 1)
 
-    def copy(self, stateful=False):
-        new_constraint = PhrasalConstraint(self.token_ids)
+    def tracked_token_ids(self):
+        return list(self.token_ids)
 
-        if stateful:
-            new_constraint.seq_len = self.seqlen
-            new_constraint.fulfilled_idx = self.fulfilled_idx
-            new_constraint.completed = self.completed
+    def state_key(self):
+        return (type(self), self.spec.key, self.fulfilled_idx, self.completed)
+
+    def num_states(self):
+        # `fulfilled_idx` goes from -1 to `seqlen - 1`, completed or not
+        return 2 * (self.seqlen + 1)
+
+    def copy(self, stateful=False):
+        # copies share the spec, which was validated when this constraint was built
+        new_constraint = PhrasalConstraint.__new__(PhrasalConstraint)
+        new_constraint.spec = self.spec
+        new_constraint.fulfilled_idx = self.fulfilled_idx if stateful else -1
+        new_constraint.completed = self.completed if stateful else False
 
         return new_constraint
 
 
 class DisjunctiveTrie:
-    def __init__(self, nested_token_ids: List[List[int]], no_subsets=True):
+    def __init__(self, nested_token_ids: List[List[int]], no_subsets=True, cache_size: int = 1024):
         r"""
         A helper class that builds a trie with the words represented in `nested_token_ids`.
+
+        The trie is stored as flat arrays, with nodes numbered breadth-first from the root `0`: the children of node
+        `i` are `child_token_ids[offsets[i]:offsets[i + 1]]` (sorted) and `child_node_ids[offsets[i]:offsets[i + 1]]`.
+        The tensors of the next tokens of the `cache_size` most recently used nodes are kept on their device.
         """
+        self.cache_size = cache_size
+        self._tensor_cache = OrderedDict()
         self.max_height = max([len(one) for one in nested_token_ids])
 
         root = {}
@@ -220,47 +363,139 @@ class DisjunctiveTrie:
 
                 level = level[token_id]
 
-        if no_subsets and self.has_subsets(root, nested_token_ids):
+        self.offsets = array("q", [0])
+        self.child_token_ids = array("q")
+        self.child_node_ids = array("q")
+        self.depths = array("q", [0])
+        levels = [root]
+        for node, level in enumerate(levels):
+            for token_id in sorted(level):
+                self.child_token_ids.append(token_id)
+                self.child_node_ids.append(len(levels))
+                self.depths.append(self.depths[node] + 1)
+                levels.append(level[token_id])
+            self.offsets.append(len(self.child_token_ids))
+        self.num_nodes = len(levels)
+
+        # the length of the shortest path from every node to a leaf, children being numbered after their parent
+        self.min_heights = array("q", [0] * self.num_nodes)
+        for node in reversed(range(self.num_nodes)):
+            if not self.is_leaf(node):
+                children = self.child_node_ids[self.offsets[node] : self.offsets[node + 1]]
+                self.min_heights[node] = 1 + min(self.min_heights[child] for child in children)
+
+        if no_subsets and self.has_subsets(nested_token_ids):
             raise ValueError(
                 "Each list in `nested_token_ids` can't be a complete subset of another list, but is"
                 f" {nested_token_ids}."
             )
 
-        self.trie = root
+    def next_node(self, node: int, token_id: int) -> Optional[int]:
+        """
+        The node reached from `node` by `token_id`, or `None` if `token_id` doesn't progress the trie.
+        """
+        start, end = self.offsets[node], self.offsets[node + 1]
+        idx = bisect_left(self.child_token_ids, token_id, start, end)
+        if idx < end and self.child_token_ids[idx] == token_id:
+            return self.child_node_ids[idx]
+        return None
+
+    def node_next_tokens(self, node: int) -> List[int]:
+        """
+        The next possible tokens that will progress the trie from `node`.
+        """
+        return self.child_token_ids[self.offsets[node] : self.offsets[node + 1]].tolist()
+
+    def is_leaf(self, node: int) -> bool:
+        return self.offsets[node] == self.offsets[node + 1]
+
+    def _cached_tensor(self, key, build):
+        tensor = self._tensor_cache.get(key)
+        if tensor is None:
+            tensor = build()
+            self._tensor_cache[key] = tensor
+            if len(self._tensor_cache) > self.cache_size:
+                self._tensor_cache.popitem(last=False)
+        else:
+            self._tensor_cache.move_to_end(key)
+        return tensor
 
-    def next_tokens(self, current_seq):
+    def next_token_ids(self, node: int, device: Union[str, torch.device] = "cpu") -> torch.LongTensor:
         """
-        The next possible tokens that will progress the trie, given the current sequence of tokens in `current_seq`.
+        The next possible tokens that will progress the trie from `node`, as a tensor on `device` that is built once
+        and then reused.
         """
-        start = self.trie
+        device = torch.device(device)
+        return self._cached_tensor(
+            ("ids", node, device),
+            lambda: torch.tensor(self.node_next_tokens(node), dtype=torch.long).to(device),
+        )
 
-        for current_token in current_seq:
-            start = start[current_token]
+    def next_token_mask(
+        self, node: int, vocab_size: int, device: Union[str, torch.device] = "cpu"
+    ) -> torch.BoolTensor:
+        """
+        A `(vocab_size,)` mask of the next possible tokens that will progress the trie from `node`, as a tensor on
+        `device` that is built once and then reused.
+        """
+        device = torch.device(device)
+        return self._cached_tensor(
+            ("mask", node, vocab_size, device),
+            lambda: torch.zeros(vocab_size, dtype=torch.bool, device=device).index_fill_(
+                0, self.next_token_ids(node, device), True
+            ),
+        )
+
+    def next_token_masks(
+        self, nodes: List[int], vocab_size: int, device: Union[str, torch.device] = "cpu"
+    ) -> torch.BoolTensor:
+        """
+        Stacks the cached [`~DisjunctiveTrie.next_token_mask`] of every node of `nodes` into a `(len(nodes),
+        vocab_size)` mask, e.g. to apply to the scores of several beams with a single `masked_fill`.
+        """
+        return torch.stack([self.next_token_mask(node, vocab_size, device) for node in nodes])
 
-        next_tokens = list(start.keys())
+    def find_node(self, current_seq):
+        node = 0
+        for current_token in current_seq:
+            node = self.next_node(node, current_token)
+        return node
 
-        return next_tokens
+    def next_tokens(self, current_seq):
+        """
+        The next possible tokens that will progress the trie, given the current sequence of tokens in `current_seq`.
+        """
+        return self.node_next_tokens(self.find_node(current_seq))
 
     def reached_leaf(self, current_seq):
-        next_tokens = self.next_tokens(current_seq)
+        return self.is_leaf(self.find_node(current_seq))
 
-        return len(next_tokens) == 0
+    def count_leaves(self):
+        return sum(self.is_leaf(node) for node in range(self.num_nodes))
 
-    def count_leaves(self, root):
-        next_nodes = list(root.values())
-        if len(next_nodes) == 0:
-            return 1
-        else:
-            return sum([self.count_leaves(nn) for nn in next_nodes])
-
-    def has_subsets(self, trie, nested_token_ids):
+    def has_subsets(self, nested_token_ids):
         """
         Returns whether # of leaves == # of words. Otherwise some word is a subset of another.
         """
-        leaf_count = self.count_leaves(trie)
+        leaf_count = self.count_leaves()
         return len(nested_token_ids) != leaf_count
 
 
+class DisjunctiveConstraintSpec(ConstraintSpec):
+    r"""
+    [`ConstraintSpec`] of a [`DisjunctiveConstraint`], which also holds the [`DisjunctiveTrie`] of its words.
+    """
+
+    __slots__ = ("trie",)
+
+    def __init__(self, nested_token_ids: List[List[int]]):
+        super().__init__(nested_token_ids)
+        trie = DisjunctiveTrie(nested_token_ids)
+        object.__setattr__(self, "key", tuple(tuple(token_ids) for token_ids in nested_token_ids))
+        object.__setattr__(self, "seqlen", trie.max_height)
+        object.__setattr__(self, "trie", trie)
+
+
 class DisjunctiveConstraint(Constraint):
     r"""
     A special [`Constraint`] that is fulfilled by fulfilling just one of several constraints.
@@ -271,6 +506,8 @@ class DisjunctiveConstraint(Constraint):
             the list of words.
     """
 
+    __slots__ = ("spec", "node", "completed")
+
     def __init__(self, nested_token_ids: List[List[int]]):
         super(Constraint, self).__init__()
 
@@ -286,15 +523,25 @@ class DisjunctiveConstraint(Constraint):
                 f"Each list in `nested_token_ids` has to be a list of positive integers, but is {nested_token_ids}."
             )
 
-        self.trie = DisjunctiveTrie(nested_token_ids)
-        self.token_ids = nested_token_ids
-
-        self.seqlen = self.trie.max_height
-        self.current_seq = []
+        self.spec = DisjunctiveConstraintSpec(nested_token_ids)
+        # the node of `self.trie` reached by the tokens generated so far
+        self.node = 0
         self.completed = False
 
+    @property
+    def trie(self):
+        return self.spec.trie
+
+    @property
+    def token_ids(self):
+        return self.spec.token_ids
+
+    @property
+    def seqlen(self):
+        return self.spec.seqlen
+
     def advance(self):
-        token_list = self.trie.next_tokens(self.current_seq)
+        token_list = self.trie.node_next_tokens(self.node)
 
         if len(token_list) == 0:
             return None
@@ -305,9 +552,13 @@ class DisjunctiveConstraint(Constraint):
         if not isinstance(token_id, int):
             raise TypeError(f"`token_id` is supposed to be type `int`, but is {token_id} of type {type(token_id)}")
 
-        next_tokens = self.trie.next_tokens(self.current_seq)
+        return self.trie.next_node(self.node, token_id) is not None
 
-        return token_id in next_tokens
+    def advance_mask(self, vocab_size: int, device: Union[str, torch.device] = "cpu") -> torch.BoolTensor:
+        """
+        A `(vocab_size,)` mask of the tokens that progress this constraint, cached by the trie for each of its nodes.
+        """
+        return self.trie.next_token_mask(self.node, vocab_size, device)
 
     def update(self, token_id: int):
         if not isinstance(token_id, int):
@@ -317,36 +568,51 @@ class DisjunctiveConstraint(Constraint):
         completed = False
         reset = False
 
-        if self.does_advance(token_id):
-            self.current_seq.append(token_id)
+        next_node = self.trie.next_node(self.node, token_id)
+        if next_node is not None:
+            self.node = next_node
             stepped = True
         else:
             reset = True
             self.reset()
 
-        completed = self.trie.reached_leaf(self.current_seq)
+        completed = self.trie.is_leaf(self.node)
         self.completed = completed
 
         return stepped, completed, reset
 
     def reset(self):
         self.completed = False
-        self.current_seq = []
+        self.node = 0
 
     def remaining(self):
         if self.completed:
             # since this can be completed without reaching max height
             return 0
         else:
-            return self.seqlen - len(self.current_seq)
+            return self.seqlen - self.trie.depths[self.node]
 
-    def copy(self, stateful=False):
-        new_constraint = DisjunctiveConstraint(self.token_ids)
+    def min_remaining(self):
+        # the shortest of the words that can still be completed
+        return 0 if self.completed else self.trie.min_heights[self.node]
 
-        if stateful:
-            new_constraint.seq_len = self.seqlen
-            new_constraint.current_seq = self.current_seq
-            new_constraint.completed = self.completed
+    def tracked_token_ids(self):
+        return sorted(set(self.trie.child_token_ids))
+
+    def state_key(self):
+        # nodes are numbered the same way in every trie built from the same `token_ids`
+        return (type(self), self.spec.key, self.node, self.completed)
+
+    def num_states(self):
+        # a constraint is completed exactly when its node is a leaf
+        return self.trie.num_nodes
+
+    def copy(self, stateful=False):
+        # copies share the spec, and with it the trie, instead of rebuilding it
+        new_constraint = DisjunctiveConstraint.__new__(DisjunctiveConstraint)
+        new_constraint.spec = self.spec
+        new_constraint.node = self.node if stateful else 0
+        new_constraint.completed = self.completed if stateful else False
 
         return new_constraint
 
@@ -383,6 +649,16 @@ class ConstraintListState:
 
         return (len(self.complete_constraints) * self.max_seqlen) + add
 
+    def remaining_steps(self):
+        """
+        Returns the least number of tokens to generate to fulfill all the constraints. Every token steps at most one
+        constraint, so it is the sum of their `min_remaining()`.
+        """
+        steps = sum(constraint.min_remaining() for constraint in self.pending_constraints)
+        if self.inprogress_constraint is not None:
+            steps += self.inprogress_constraint.min_remaining()
+        return steps
+
     def advance(self):
         """The list of tokens to generate such that we can make progress.
         By "list" we don't mean the list of token that will fully fulfill a constraint.
@@ -397,6 +673,9 @@ class ConstraintListState:
 
         Though we don't care which constraint is fulfilled first, if we are in the progress of fulfilling a constraint,
         that's the only one we'll return.
+
+        If any token of the vocabulary makes progress (e.g. a `None` slot of a [`TemplateConstraint`]), the list holds
+        a single `WILDCARD` entry instead of the whole vocabulary.
         """
         token_list = []
         if self.inprogress_constraint is None:
@@ -406,12 +685,16 @@ class ConstraintListState:
                     token_list.append(advance)
                 elif isinstance(advance, list):
                     token_list.extend(advance)
+                elif advance is WILDCARD and WILDCARD not in token_list:
+                    token_list.append(advance)
         else:
             advance = self.inprogress_constraint.advance()
             if isinstance(advance, int):
                 token_list.append(advance)
             elif isinstance(advance, list):
                 token_list.extend(advance)
+            elif advance is WILDCARD:
+                token_list.append(advance)
 
         if len(token_list) == 0:
             return None
@@ -520,25 +803,424 @@ class ConstraintListState:
             if self.inprogress_constraint is not None:
                 new_state.inprogress_constraint = self.inprogress_constraint.copy(stateful=True)
             new_state.pending_constraints = [constraint.copy() for constraint in self.pending_constraints]
+            new_state.completed = self.completed
 
         return new_state
 
+    def state_key(self):
+        """
+        Returns a hashable snapshot of the progress through the list of constraints. Completed constraints are never
+        updated again, so only how many of them there are matters.
+        """
+        inprogress_key = None if self.inprogress_constraint is None else self.inprogress_constraint.state_key()
+        pending_keys = tuple(constraint.state_key() for constraint in self.pending_constraints)
+        return (self.completed, len(self.complete_constraints), inprogress_key, pending_keys)
+
+
+class ConstraintDFA:
+    r"""
+    A list of constraints compiled into a deterministic finite automaton. The progress of a beam through the
+    constraints becomes a single integer state id, so that all the beams can be stepped at once with a tensor gather
+    instead of copying and updating [`ConstraintListState`] objects.
+
+    The states are discovered by simulating [`ConstraintListState`] on every token id the constraints react to (see
+    [`Constraint.tracked_token_ids`]) and on one representative of all the other tokens, which share the default edge
+    of each state. State `0` is the initial state.
+
+    Args:
+        constraints (`List[Constraint]`):
+            The constraints to compile. All of them must implement [`Constraint.tracked_token_ids`] and
+            [`Constraint.state_key`].
+        max_states (`int`, *optional*, defaults to 4096):
+            The maximum number of states of the automaton. Compiling fails with a `ValueError` beyond it.
+    """
+
+    def __init__(self, constraints: List[Constraint], max_states: int = 4096):
+        self.constraints = constraints
+        self.max_states = max_states
+
+        tracked_token_ids = sorted({token_id for c in constraints for token_id in c.tracked_token_ids()})
+        # a token id that no constraint reacts to stands for all of them
+        other_token_id = tracked_token_ids[-1] + 1 if len(tracked_token_ids) > 0 else 0
+        alphabet = tracked_token_ids + [other_token_id]
+
+        root = ConstraintListState(constraints)
+        states = [root]
+        state_ids = {root.state_key(): 0}
+        transitions = []
+        for state in states:  # `states` grows while it is walked, breadth first
+            row = []
+            for token_id in alphabet:
+                next_state = state.copy(stateful=True)
+                next_state.add(token_id)
+                key = next_state.state_key()
+                if key not in state_ids:
+                    if len(states) == max_states:
+                        raise ValueError(
+                            f"The constraints need more than `max_states` ({max_states}) states to be compiled."
+                        )
+                    state_ids[key] = len(states)
+                    states.append(next_state)
+                row.append(state_ids[key])
+            transitions.append(row)
+
+        self.num_states = len(states)
+
+        # host-side tables, to propose the tokens that advance a beam (see `ConstraintListState.advance`)
+        self.state_completed = [state.completed for state in states]
+        self.state_advance = [state.advance() for state in states]
+        self.has_wildcard = any(advance is not None and WILDCARD in advance for advance in self.state_advance)
+
+        # `transitions[state_id, i]` is the next state after `token_ids[i]`, the last column is the default edge
+        self.token_ids = torch.tensor(tracked_token_ids, dtype=torch.long)
+        self.transitions = torch.tensor(transitions, dtype=torch.int32)
+        self.completed = torch.tensor(self.state_completed, dtype=torch.bool)
+        self.banks = torch.tensor([state.get_bank() for state in states], dtype=torch.long)
+        self.remaining_steps = torch.tensor([state.remaining_steps() for state in states], dtype=torch.long)
+
+        # device-side copy of `state_advance`: the explicit tokens of every state padded with -1, and whether any token
+        # advances it
+        advance_tokens = [
+            [token_id for token_id in advance if token_id is not WILDCARD] if advance is not None else []
+            for advance in self.state_advance
+        ]
+        max_advance = max(len(tokens) for tokens in advance_tokens)
+        self.advance_tokens = torch.tensor(
+            [tokens + [-1] * (max_advance - len(tokens)) for tokens in advance_tokens], dtype=torch.long
+        ).view(self.num_states, max_advance)
+        self.advance_any = torch.tensor(
+            [advance is not None and WILDCARD in advance for advance in self.state_advance], dtype=torch.bool
+        )
+
+    @staticmethod
+    def estimate_num_states(constraints: List[Constraint]) -> int:
+        """
+        Returns an upper bound on the number of states of the automaton of `constraints`, computed from
+        [`Constraint.num_states`] without exploring them. A state is the order of the pending constraints, all in their
+        initial state, and the constraint in progress with its own state, the others being complete.
+        """
+        # the number of ordered selections of pending constraints
+        num_orders, num_selections = 1, 1
+        for num_pending in range(len(constraints), 0, -1):
+            num_orders *= num_pending
+            num_selections += num_orders
+        num_in_progress = 1 + sum(constraint.num_states() - 1 for constraint in constraints)
+        return num_selections * num_in_progress
+
+    def to(self, device):
+        self.token_ids = self.token_ids.to(device)
+        self.transitions = self.transitions.to(device)
+        self.completed = self.completed.to(device)
+        self.banks = self.banks.to(device)
+        self.remaining_steps = self.remaining_steps.to(device)
+        self.advance_tokens = self.advance_tokens.to(device)
+        self.advance_any = self.advance_any.to(device)
+        return self
+
+    def step(self, state_ids: torch.IntTensor, token_ids: torch.LongTensor) -> torch.IntTensor:
+        """
+        Returns the states reached from `state_ids` after generating `token_ids`, both of the same shape.
+        """
+        num_tracked = self.token_ids.shape[0]
+        if num_tracked > 0:
+            columns = torch.searchsorted(self.token_ids, token_ids.contiguous())
+            is_tracked = self.token_ids[columns.clamp(max=num_tracked - 1)] == token_ids
+            columns = torch.where(is_tracked, columns, num_tracked)
+        else:
+            columns = torch.zeros_like(token_ids)
+        return self.transitions[state_ids, columns]
+
+    def initial_states(self, input_ids: torch.LongTensor) -> torch.IntTensor:
+        """
+        Returns the states reached by each row of `input_ids`, of shape `(batch_size, sequence_length)`.
+        """
+        state_ids = torch.zeros(input_ids.shape[0], dtype=torch.int32, device=input_ids.device)
+        for column in range(input_ids.shape[-1]):
+            state_ids = self.step(state_ids, input_ids[:, column])
+        return state_ids
+
+    def get_completed(self, state_ids: torch.IntTensor) -> torch.BoolTensor:
+        """
+        Returns whether each of `state_ids` fulfilled all the constraints.
+        """
+        return self.completed[state_ids]
+
+    def get_banks(self, state_ids: torch.IntTensor) -> torch.LongTensor:
+        """
+        Returns the bank of each of `state_ids` (see [`ConstraintListState.get_bank`]).
+        """
+        return self.banks[state_ids]
+
+    def get_remaining_steps(self, state_ids: torch.IntTensor) -> torch.LongTensor:
+        """
+        Returns the least number of tokens to generate from each of `state_ids` to fulfill all the constraints (see
+        [`ConstraintListState.remaining_steps`]).
+        """
+        return self.remaining_steps[state_ids]
+
+    def get_advances(self, state_ids: Union[torch.IntTensor, List[int]]):
+        """
+        Returns, for each of `state_ids`, whether it fulfilled all the constraints and the tokens that would advance it
+        (see [`ConstraintListState.advance`]). `state_ids` can also be given as a list, already on the host.
+        """
+        if isinstance(state_ids, torch.Tensor):
+            state_ids = state_ids.tolist()
+        return [(self.state_completed[state_id], self.state_advance[state_id]) for state_id in state_ids]
+
+    def get_advance_tokens(self, state_ids: torch.IntTensor) -> Tuple[torch.LongTensor, torch.BoolTensor]:
+        """
+        Returns, for each of `state_ids`, the tokens that would advance it padded with -1, of shape `(len(state_ids),
+        max_tokens)`, and whether any token would advance it. Unlike [`~ConstraintDFA.get_advances`], it stays on the
+        device.
+        """
+        return self.advance_tokens[state_ids], self.advance_any[state_ids]
+
+
+class BatchedConstraintListState:
+    r"""
+    The progress of a batch of beams through a list of constraints, stored as arrays instead of one
+    [`ConstraintListState`] per beam. Unlike [`ConstraintDFA`], which enumerates every combination of progress through
+    all the constraints, each constraint is compiled on its own, so that the tables stay small with many constraints.
+
+    The state of the beams is an int32 tensor of shape `(batch_size * num_beams, 3, n_constraints)` whose rows hold, for
+    every constraint:
+
+        - `states[:, STATUS]`: whether it is pending, in progress or complete (see [`ConstraintListState`]),
+        - `states[:, POSITION]`: the state of the constraint itself, `0` being its initial state,
+        - `states[:, ORDER]`: the place of a pending constraint in the queue, a constraint whose progress was broken
+          goes back to the end of it.
+
+    All the methods work on any number of leading dimensions, so that stepping, computing banks and reordering beams
+    are plain tensor ops. Every constraint must implement [`Constraint.tracked_token_ids`] and
+    [`Constraint.state_key`], which is all it takes to convert an existing [`Constraint`] subclass.
+
+    Args:
+        constraints (`List[Constraint]`):
+            The constraints to track.
+        max_states (`int`, *optional*, defaults to 4096):
+            The maximum number of states of each constraint. Compiling fails with a `ValueError` beyond it.
+    """
+
+    STATUS, POSITION, ORDER = 0, 1, 2
+    PENDING, IN_PROGRESS, COMPLETE = 0, 1, 2
+
+    def __init__(self, constraints: List[Constraint], max_states: int = 4096):
+        self.constraints = constraints
+        self.n_constraints = len(constraints)
+        self.max_seqlen = max([c.seqlen for c in constraints])
+
+        tracked_token_ids = sorted({token_id for c in constraints for token_id in c.tracked_token_ids()})
+        # a token id that no constraint reacts to stands for all of them
+        other_token_id = tracked_token_ids[-1] + 1 if len(tracked_token_ids) > 0 else 0
+        alphabet = tracked_token_ids + [other_token_id]
+
+        tables = [self._compile_constraint(c, alphabet, max_states) for c in constraints]
+        num_states = max(len(table["remaining"]) for table in tables)
+
+        def stack(name, dtype, default):
+            padded = [table[name] + [[default] * len(alphabet)] * (num_states - len(table[name])) for table in tables]
+            return torch.tensor(padded, dtype=dtype)
+
+        # host-side table, to propose the tokens that advance a beam (see `ConstraintListState.advance`)
+        self.state_advance = [table["advance"] for table in tables]
+        self.has_wildcard = any(advance is WILDCARD for advances in self.state_advance for advance in advances)
+
+        # `table[c, position, i]` is the outcome of `token_ids[i]` for constraint `c` at `position`, the last column
+        # is the default edge
+        self.token_ids = torch.tensor(tracked_token_ids, dtype=torch.long)
+        self.next_position = stack("next_position", torch.int32, 0)
+        self.does_advance = stack("does_advance", torch.bool, False)
+        self.completes = stack("completes", torch.bool, False)
+        self.resets = stack("resets", torch.bool, False)
+        self.remaining = torch.tensor(
+            [table["remaining"] + [0] * (num_states - len(table["remaining"])) for table in tables], dtype=torch.long
+        )
+        self.min_remaining = torch.tensor(
+            [table["min_remaining"] + [0] * (num_states - len(table["min_remaining"])) for table in tables],
+            dtype=torch.long,
+        )
+
+    @staticmethod
+    def _compile_constraint(constraint: Constraint, alphabet: List[int], max_states: int):
+        root = constraint.copy(stateful=False)
+        states = [root]
+        state_ids = {root.state_key(): 0}
+        table = {"next_position": [], "does_advance": [], "completes": [], "resets": []}
+        for state in states:  # `states` grows while it is walked, breadth first
+            rows = {name: [] for name in table}
+            for token_id in alphabet:
+                next_state = state.copy(stateful=True)
+                if state.completed:
+                    # a complete constraint is never updated again
+                    does_advance, stepped, complete, reset = False, False, False, False
+                else:
+                    does_advance = next_state.does_advance(token_id)
+                    stepped, complete, reset = next_state.update(token_id)
+                rows["does_advance"].append(does_advance)
+                rows["completes"].append(complete)
+                rows["resets"].append(reset)
+                if reset:
+                    # the broken constraint is replaced by a fresh copy (see `ConstraintListState.add`)
+                    rows["next_position"].append(0)
+                    continue
+                key = next_state.state_key()
+                if key not in state_ids:
+                    if len(states) == max_states:
+                        raise ValueError(
+                            f"{constraint.__class__} needs more than `max_states` ({max_states}) states to be compiled."
+                        )
+                    state_ids[key] = len(states)
+                    states.append(next_state)
+                rows["next_position"].append(state_ids[key])
+            for name, row in rows.items():
+                table[name].append(row)
+
+        table["remaining"] = [state.remaining() for state in states]
+        table["min_remaining"] = [state.min_remaining() for state in states]
+        table["advance"] = [state.advance() for state in states]
+        return table
+
+    def to(self, device):
+        self.token_ids = self.token_ids.to(device)
+        self.next_position = self.next_position.to(device)
+        self.does_advance = self.does_advance.to(device)
+        self.completes = self.completes.to(device)
+        self.resets = self.resets.to(device)
+        self.remaining = self.remaining.to(device)
+        self.min_remaining = self.min_remaining.to(device)
+        return self
+
+    def step(self, states: torch.IntTensor, token_ids: torch.LongTensor) -> torch.IntTensor:
+        """
+        Returns the states reached from `states` after generating `token_ids`, which has the same leading dimensions.
+        This mirrors [`ConstraintListState.add`].
+        """
+        num_tracked = self.token_ids.shape[0]
+        if num_tracked > 0:
+            columns = torch.searchsorted(self.token_ids, token_ids.contiguous())
+            is_tracked = self.token_ids[columns.clamp(max=num_tracked - 1)] == token_ids
+            columns = torch.where(is_tracked, columns, num_tracked)
+        else:
+            columns = torch.zeros_like(token_ids)
+
+        status, position, order = states.unbind(-2)
+        constraint_ids = torch.arange(self.n_constraints, device=states.device)
+        lookup = (constraint_ids, position, columns.unsqueeze(-1))
+
+        # 1. the constraint in progress, if any, is updated with the token
+        is_inprogress = status == self.IN_PROGRESS
+        has_inprogress = is_inprogress.any(dim=-1, keepdim=True)
+        # 2. otherwise, the first pending constraint in the queue that the token advances is updated
+        candidates = (status == self.PENDING) & self.does_advance[lookup] & ~has_inprogress
+        first_candidate = torch.where(candidates, order, torch.iinfo(order.dtype).max).argmin(dim=-1, keepdim=True)
+        is_first_candidate = (constraint_ids == first_candidate) & candidates
+        updated = is_inprogress | is_first_candidate
+
+        resets = updated & self.resets[lookup]
+        completes = updated & self.completes[lookup] & ~resets
+
+        new_status = torch.where(updated, self.IN_PROGRESS, status)
+        new_status = torch.where(completes, self.COMPLETE, new_status)
+        new_status = torch.where(resets, self.PENDING, new_status)
+        new_position = torch.where(updated, self.next_position[lookup], position)
+        new_position = torch.where(resets, 0, new_position)
+        new_order = torch.where(resets, order.max(dim=-1, keepdim=True).values + 1, order)
+
+        return torch.stack((new_status, new_position, new_order), dim=-2).to(states.dtype)
+
+    def initial_states(self, input_ids: torch.LongTensor) -> torch.IntTensor:
+        """
+        Returns the states reached by each row of `input_ids`, of shape `(batch_size, sequence_length)`.
+        """
+        states = torch.zeros((input_ids.shape[0], 3, self.n_constraints), dtype=torch.int32, device=input_ids.device)
+        states[:, self.ORDER] = torch.arange(self.n_constraints, dtype=torch.int32, device=input_ids.device)
+        for column in range(input_ids.shape[-1]):
+            states = self.step(states, input_ids[:, column])
+        return states
+
+    def get_completed(self, states: torch.IntTensor) -> torch.BoolTensor:
+        """
+        Returns whether each of `states` fulfilled all the constraints.
+        """
+        return (states[..., self.STATUS, :] == self.COMPLETE).all(dim=-1)
+
+    def get_banks(self, states: torch.IntTensor) -> torch.LongTensor:
+        """
+        Returns the bank of each of `states` (see [`ConstraintListState.get_bank`]).
+        """
+        status, position = states[..., self.STATUS, :], states[..., self.POSITION, :]
+        constraint_ids = torch.arange(self.n_constraints, device=states.device)
+        # extra points for having a constraint mid-fulfilled
+        progress = self.max_seqlen - self.remaining[constraint_ids, position]
+        add = torch.where(status == self.IN_PROGRESS, progress, 0).sum(dim=-1)
+        return (status == self.COMPLETE).sum(dim=-1) * self.max_seqlen + add
+
+    def get_remaining_steps(self, states: torch.IntTensor) -> torch.LongTensor:
+        """
+        Returns the least number of tokens to generate from each of `states` to fulfill all the constraints (see
+        [`ConstraintListState.remaining_steps`]).
+        """
+        status, position = states[..., self.STATUS, :], states[..., self.POSITION, :]
+        constraint_ids = torch.arange(self.n_constraints, device=states.device)
+        steps = self.min_remaining[constraint_ids, position]
+        return torch.where(status == self.COMPLETE, 0, steps).sum(dim=-1)
+
+    def get_advances(self, states: Union[torch.IntTensor, List[List[List[int]]]]):
+        """
+        Returns, for each of `states`, whether it fulfilled all the constraints and the tokens that would advance it
+        (see [`ConstraintListState.advance`]). `states` can also be given as nested lists, already on the host.
+        """
+        if isinstance(states, torch.Tensor):
+            states = states.tolist()
+        advances = []
+        for status, position, order in states:
+            if status.count(self.IN_PROGRESS) > 0:
+                cidx = status.index(self.IN_PROGRESS)
+                constraint_advances = [self.state_advance[cidx][position[cidx]]]
+            else:
+                pending = sorted((o, cidx) for cidx, (s, o) in enumerate(zip(status, order)) if s == self.PENDING)
+                constraint_advances = [self.state_advance[cidx][0] for _, cidx in pending]
+
+            token_list = []
+            for advance in constraint_advances:
+                if isinstance(advance, int):
+                    token_list.append(advance)
+                elif isinstance(advance, list):
+                    token_list.extend(advance)
+                elif advance is WILDCARD and WILDCARD not in token_list:
+                    token_list.append(advance)
+
+            completed = all(s == self.COMPLETE for s in status)
+            advances.append((completed, token_list if len(token_list) > 0 else None))
+        return advances
+
 
 class TemplateConstraint(Constraint):
-    def __init__(self, template: List[Optional[int]], vocab_length: int):
-        
-        self.template = template
-        self.seqlen = len(template)
+    __slots__ = ("spec", "position", "completed")
+
+    def __init__(self, template: List[Optional[int]], vocab_length: Optional[int] = None):
+        self.spec = ConstraintSpec(template, vocab_length)
         self.position = 0
         self.completed = False
-        self.vocab_length = vocab_length
         super().__init__()
 
+    @property
+    def template(self):
+        return self.spec.token_ids
+
+    @property
+    def seqlen(self):
+        return self.spec.seqlen
+
+    @property
+    def vocab_length(self):
+        return self.spec.vocab_length
+
     def advance(self):
         if self.completed:
             return []
         if self.template[self.position] is None:
-            return list(range(self.vocab_length))
+            return WILDCARD
         else:
             return self.template[self.position]
 
@@ -563,22 +1245,45 @@ class TemplateConstraint(Constraint):
     def remaining(self):
         return self.seqlen - self.position
 
+    def tracked_token_ids(self):
+        return [token_id for token_id in self.template if token_id is not None]
+
+    def state_key(self):
+        return (type(self), self.spec.key, self.position, self.completed)
+
+    def num_states(self):
+        # `position` goes from 0 to `seqlen`, the constraint being completed exactly at the end
+        return self.seqlen + 1
+
     def copy(self, stateful=False):
-        new = TemplateConstraint(self.template, self.vocab_length)
-        if stateful:
-            new.position = self.position
-            new.completed = self.completed
+        # copies share the spec, which was validated when this constraint was built
+        new = TemplateConstraint.__new__(TemplateConstraint)
+        new.spec = self.spec
+        new.position = self.position if stateful else 0
+        new.completed = self.completed if stateful else False
         return new
 
 class OrderedConstraint(Constraint):
-    def __init__(self, ordered_token_ids: List[Optional[int]], vocab_length: int):
-        self.ordered_token_ids = ordered_token_ids
-        self.vocab_length = vocab_length
+    __slots__ = ("spec", "position", "completed")
+
+    def __init__(self, ordered_token_ids: List[Optional[int]], vocab_length: Optional[int] = None):
+        self.spec = ConstraintSpec(ordered_token_ids, vocab_length)
         self.position = 0 
         self.completed = False 
-        self.seqlen = len(ordered_token_ids)
         super().__init__()
 
+    @property
+    def ordered_token_ids(self):
+        return self.spec.token_ids
+
+    @property
+    def seqlen(self):
+        return self.spec.seqlen
+
+    @property
+    def vocab_length(self):
+        return self.spec.vocab_length
+
     def advance(self):
         """Returns the next set of tokens that can be used to move the constraint forward."""
         if self.completed:
@@ -588,6 +1293,9 @@ class OrderedConstraint(Constraint):
             self.completed = True
             return []  # All constraints yay
 
+        if self.ordered_token_ids[self.position] is None:
+            return WILDCARD
+
         return self.ordered_token_ids[self.position]
 
     # def does_advance(self, token_id: int):
@@ -645,22 +1353,45 @@ class OrderedConstraint(Constraint):
     def remaining(self):
         return len(self.ordered_token_ids) - self.position
 
+    def tracked_token_ids(self):
+        return [token_id for token_id in self.ordered_token_ids if token_id is not None]
+
+    def state_key(self):
+        return (type(self), self.spec.key, self.position, self.completed)
+
+    def num_states(self):
+        # `position` goes from 0 to `seqlen`, the constraint being completed exactly at the end
+        return self.seqlen + 1
+
     def copy(self, stateful=False):
-        new_constraint = OrderedConstraint(self.ordered_token_ids, self.vocab_length)
-        if stateful:
-            new_constraint.position = self.position
-            new_constraint.completed = self.completed
+        # copies share the spec, which was validated when this constraint was built
+        new_constraint = OrderedConstraint.__new__(OrderedConstraint)
+        new_constraint.spec = self.spec
+        new_constraint.position = self.position if stateful else 0
+        new_constraint.completed = self.completed if stateful else False
         return new_constraint
 
 class OrderedConstraintJunyao(Constraint):
-    def __init__(self, ordered_token_ids: List[int], vocab_length: int):
-        self.ordered_token_ids = ordered_token_ids
-        self.seqlen = len(ordered_token_ids)
+    __slots__ = ("spec", "position", "completed")
+
+    def __init__(self, ordered_token_ids: List[int], vocab_length: Optional[int] = None):
+        self.spec = ConstraintSpec(ordered_token_ids, vocab_length)
         self.position = 0
         self.completed = False
-        self.vocab_length = vocab_length
         super().__init__()
 
+    @property
+    def ordered_token_ids(self):
+        return self.spec.token_ids
+
+    @property
+    def seqlen(self):
+        return self.spec.seqlen
+
+    @property
+    def vocab_length(self):
+        return self.spec.vocab_length
+
     def advance(self):
         if self.completed:
             return []
@@ -686,9 +1417,20 @@ class OrderedConstraintJunyao(Constraint):
     def remaining(self):
         return self.seqlen - self.position
 
+    def tracked_token_ids(self):
+        return list(self.ordered_token_ids)
+
+    def state_key(self):
+        return (type(self), self.spec.key, self.position, self.completed)
+
+    def num_states(self):
+        # `position` goes from 0 to `seqlen`, the constraint being completed exactly at the end
+        return self.seqlen + 1
+
     def copy(self, stateful=False):
-        new = OrderedConstraintJunyao(self.ordered_token_ids, self.vocab_length)
-        if stateful:
-            new.position = self.position
-            new.completed = self.completed
+        # copies share the spec, which was validated when this constraint was built
+        new = OrderedConstraintJunyao.__new__(OrderedConstraintJunyao)
+        new.spec = self.spec
+        new.position = self.position if stateful else 0
+        new.completed = self.completed if stateful else False
         return new
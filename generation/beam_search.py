@@ -13,17 +13,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
+import weakref
 from abc import ABC, abstractmethod
-from collections import UserDict
+from collections import OrderedDict, UserDict
 from typing import Dict, List, Optional, Tuple, Union
 
-import numpy as np
 import torch
 
 from ..utils import add_start_docstrings
-from .beam_constraints import Constraint, ConstraintListState
+from ..utils.logging import get_logger
+from .beam_constraints import (
+    WILDCARD,
+    BatchedConstraintListState,
+    Constraint,
+    ConstraintDFA,
+    ConstraintListState,
+)
 
 
+logger = get_logger(__name__)
+
+# compiled constraints of the most recent scorers, keyed by the `Constraint.validation_key`s of their constraints and
+# their device, see `_compile_constraints`
+_compiled_constraints_cache = OrderedDict()
+_MAX_COMPILED_CONSTRAINTS = 32
+
 PROCESS_INPUTS_DOCSTRING = r"""
     Args:
         input_ids (`torch.LongTensor` of shape `(batch_size * num_beams, sequence_length)`):
@@ -416,6 +431,136 @@ class BeamSearchScorer(BeamScorer):
         )
 
 
+def _to_host(tensors: Dict[str, torch.Tensor]) -> Dict[str, list]:
+    """
+    Brings `tensors` to the host as (nested) lists while waiting on the device only once: on CUDA they are all copied
+    asynchronously to pinned memory before synchronizing with the stream.
+    """
+    if any(tensor.device.type == "cuda" for tensor in tensors.values()):
+        device = next(tensor.device for tensor in tensors.values() if tensor.device.type == "cuda")
+        tensors = {name: tensor.to("cpu", non_blocking=True) for name, tensor in tensors.items()}
+        torch.cuda.current_stream(device).synchronize()
+    return {name: tensor.tolist() for name, tensor in tensors.items()}
+
+
+def _to_device(values: Dict[str, List[int]], device: torch.device) -> Dict[str, torch.LongTensor]:
+    """
+    Moves lists of integers to `device` as `torch.LongTensor`s with a single copy that, on CUDA, doesn't wait on the
+    device.
+    """
+    packed = torch.tensor([value for values_list in values.values() for value in values_list], dtype=torch.long)
+    if torch.device(device).type == "cuda":
+        packed = packed.pin_memory()
+    packed = packed.to(device, non_blocking=True)
+    return dict(zip(values.keys(), packed.split([len(values_list) for values_list in values.values()])))
+
+
+def _compile_constraints(
+    constraints: List[Constraint], device: torch.device, max_states: int = 4096
+) -> Optional[Union[ConstraintDFA, BatchedConstraintListState]]:
+    """
+    Returns `constraints` compiled into a [`ConstraintDFA`] if [`ConstraintDFA.estimate_num_states`] stays within
+    `max_states`, otherwise into a [`BatchedConstraintListState`] if each of them has at most `max_states` states, on
+    `device`. Returns `None` when one of them doesn't implement the methods compiling needs or has too many states.
+    The backend is chosen from [`Constraint.num_states`] before compiling anything, and the result is cached across
+    calls for constraints with a `validation_key`, which neither automaton is ever modified by.
+    """
+    validation_keys = tuple(constraint.validation_key() for constraint in constraints)
+    cache_key = None if None in validation_keys else (validation_keys, torch.device(device))
+    if cache_key in _compiled_constraints_cache:
+        _compiled_constraints_cache.move_to_end(cache_key)
+        return _compiled_constraints_cache[cache_key]
+
+    try:
+        # constraints only implement the methods compiling needs optionally
+        for constraint in constraints:
+            constraint.tracked_token_ids()
+            constraint.state_key()
+        constraint_num_states = [constraint.num_states() for constraint in constraints]
+    except NotImplementedError as error:
+        logger.info(f"Tracking the constraints with `ConstraintListState` objects: {error}")
+        constraint_num_states = None
+
+    if constraint_num_states is None:
+        compiled = None
+    elif ConstraintDFA.estimate_num_states(constraints) <= max_states:
+        compiled = ConstraintDFA(constraints, max_states).to(device)
+    elif max(constraint_num_states) <= max_states:
+        logger.info(
+            "The constraints may have too many combinations of progress to be compiled into a `ConstraintDFA`,"
+            " tracking each of them in a `BatchedConstraintListState` instead."
+        )
+        compiled = BatchedConstraintListState(constraints, max_states).to(device)
+    else:
+        logger.info(
+            f"A constraint may have more than {max_states} states, tracking the constraints with"
+            " `ConstraintListState` objects instead of compiling them."
+        )
+        compiled = None
+
+    if cache_key is not None:
+        _compiled_constraints_cache[cache_key] = compiled
+        if len(_compiled_constraints_cache) > _MAX_COMPILED_CONSTRAINTS:
+            _compiled_constraints_cache.popitem(last=False)
+    return compiled
+
+
+def select_by_bank(
+    banks: torch.LongTensor,
+    scores: torch.FloatTensor,
+    is_valid: torch.BoolTensor,
+    num_beams: int,
+    is_demoted: Optional[torch.BoolTensor] = None,
+) -> torch.LongTensor:
+    r"""
+    Selects, for every batch item, `num_beams` hypotheses among its candidates so that the hypotheses that made
+    progress through the constraints are not crowded out by the more likely ones.
+
+    Candidates are sorted by `banks * 100 + scores` and the runs of equal banks are then taken round-robin: the best
+    candidate of every run first, then the second best of every run, and so on. Everything happens on the device of
+    `scores`, without synchronizing with the host.
+
+    Args:
+        banks (`torch.LongTensor` of shape `(batch_size, num_candidates)`):
+            The bank of each candidate hypothesis (see [`ConstraintListState.get_bank`]).
+        scores (`torch.FloatTensor` of shape `(batch_size, num_candidates)`):
+            The score of each candidate hypothesis.
+        is_valid (`torch.BoolTensor` of shape `(batch_size, num_candidates)`):
+            Whether each candidate is a hypothesis or padding. Padding is never selected before a hypothesis.
+        num_beams (`int`):
+            The number of hypotheses to select per batch item.
+        is_demoted (`torch.BoolTensor` of shape `(batch_size, num_candidates)`, *optional*):
+            Whether each hypothesis is only to be selected once all the others are, e.g. because it can't fulfill the
+            constraints anymore. Demoted hypotheses are taken round-robin among themselves.
+
+    Return:
+        `torch.LongTensor` of shape `(batch_size, num_beams)`: The indices of the selected candidates.
+    """
+    num_candidates = banks.shape[-1]
+    positions = torch.arange(num_candidates, device=banks.device).expand_as(banks)
+
+    zipped = banks * 100 + scores
+    order = zipped.sort(dim=-1, descending=True, stable=True).indices
+    # move the demoted hypotheses after the others and the padding after all of them, keeping the order of each
+    tiers = (~is_valid).long() * 2
+    if is_demoted is not None:
+        tiers = tiers + (is_demoted & is_valid).long()
+    order = order.gather(-1, tiers.gather(-1, order).sort(dim=-1, stable=True).indices)
+    sorted_banks = banks.gather(-1, order)
+    sorted_tiers = tiers.gather(-1, order)
+
+    # Then we end up with {sorted among bank C}, {sorted among bank C-1}, ..., {sorted among bank 0}, and the rank of
+    # each candidate within its run of equal banks decides the round it is taken in
+    is_run_start = torch.ones_like(is_valid)
+    is_run_start[:, 1:] = (sorted_banks[:, 1:] != sorted_banks[:, :-1]) | (sorted_tiers[:, 1:] != sorted_tiers[:, :-1])
+    increments = positions - torch.where(is_run_start, positions, 0).cummax(dim=-1).values
+    increments = increments + (sorted_tiers == 1).long() * num_candidates
+    increments = increments.masked_fill(sorted_tiers == 2, 2 * num_candidates)
+    rearrangers = increments.sort(dim=-1, stable=True).indices[:, :num_beams]
+
+    return order.gather(-1, rearrangers)
+
+
 class ConstrainedBeamSearchScorer(BeamScorer):
     r"""
     [`BeamScorer`] implementing constrained beam search decoding.
@@ -451,8 +596,35 @@ class ConstrainedBeamSearchScorer(BeamScorer):
             See [this paper](https://arxiv.org/pdf/1610.02424.pdf) for more details.
         max_length (`int`, *optional*):
             The maximum length of the sequence to be generated.
+        compile_constraints (`bool`, *optional*, defaults to `True`):
+            Whether to compile `constraints` into a [`ConstraintDFA`], so that the progress of each beam is a single
+            integer stepped with tensor ops. When the automaton could have too many states, the constraints are
+            compiled one by one into a [`BatchedConstraintListState`] instead. The choice is made from
+            [`Constraint.num_states`] before compiling anything, and the compiled constraints are reused by the next
+            scorers built with the same constraints. Constraints that can't be compiled are tracked with
+            [`ConstraintListState`] objects.
+        advance_budget (`int`, *optional*):
+            The maximum number of tokens that advance the constraints proposed as new hypotheses for each beam at every
+            step. Only the most likely ones are kept, so that the number of candidates stays bounded by
+            `num_beams * advance_budget` however many tokens the constraints allow. By default every such token is
+            proposed.
+        prune_infeasible_beams (`bool`, *optional*, defaults to `False`):
+            Whether, given `max_length`, hypotheses that need more tokens than they have left to fulfill the
+            constraints are only kept when there aren't enough other ones. On top of that, a batch item none of whose
+            beams can fulfill the constraints anymore is finished right away: its most likely candidates of the current
+            step are added as final hypotheses even though they don't fulfill the constraints, and the search stops
+            for it. This changes the outputs, so it has to be asked for.
+        constraint_aware_early_stopping (`bool`, *optional*, defaults to `False`):
+            Whether, with `do_early_stopping=False`, the candidates that can never become a kept hypothesis are left
+            out when deciding whether a batch item can still find better hypotheses. Only hypotheses that fulfill all
+            the constraints are kept, so this leaves out the eos candidates that don't fulfill them and, given
+            `max_length`, the candidates that need more tokens than they have left to fulfill them. The candidates
+            that can still fulfill the constraints in time are considered as usual.
     """
 
+    # logits processors waiting for the scorers of their constraints, see `attach_on_init`
+    _processors_to_attach = weakref.WeakSet()
+
     def __init__(
         self,
         batch_size: int,
@@ -464,6 +636,10 @@ class ConstrainedBeamSearchScorer(BeamScorer):
         num_beam_hyps_to_keep: Optional[int] = 1,
         num_beam_groups: Optional[int] = 1,
         max_length: Optional[int] = None,
+        compile_constraints: Optional[bool] = True,
+        advance_budget: Optional[int] = None,
+        prune_infeasible_beams: Optional[bool] = False,
+        constraint_aware_early_stopping: Optional[bool] = False,
     ):
         self.num_beams = num_beams
         self.device = device
@@ -473,6 +649,11 @@ class ConstrainedBeamSearchScorer(BeamScorer):
         self.num_beam_groups = num_beam_groups
         self.group_size = self.num_beams // self.num_beam_groups
         self.constraints = constraints
+        self.advance_budget = advance_budget
+        self.max_length = max_length
+        # the beams can't fulfill the constraints past `max_length`, so those that won't make it in time are given up
+        self.prune_infeasible_beams = prune_infeasible_beams and max_length is not None
+        self.constraint_aware_early_stopping = constraint_aware_early_stopping and do_early_stopping is False
 
         self._is_init = False
         self._beam_hyps = [
@@ -485,6 +666,17 @@ class ConstrainedBeamSearchScorer(BeamScorer):
             for _ in range(batch_size)
         ]
         self._done = torch.tensor([False for _ in range(batch_size)], dtype=torch.bool, device=self.device)
+        # host copy of `self._done`, so that reading it doesn't wait on the device
+        self._host_done = [False for _ in range(batch_size)]
+        # self._beam_states[i] tracks the progress of `input_ids[i]` through the constraints. It is built from the
+        # prompt on the first call to `process` and then advanced by exactly one token per step. With
+        # `self._compiled_constraints` it is an int32 tensor whose leading dimension indexes the beams, otherwise a
+        # list of `ConstraintListState`.
+        self._beam_states = None
+        # self._beam_seq_ids[i] is the index of the first beam of the batch item of `input_ids[i]` that holds the same
+        # sequence, so that duplicated hypotheses can be told apart without comparing sequences.
+        self._beam_seq_ids = None
+        self._compiled_constraints = _compile_constraints(constraints, device) if compile_constraints else None
 
         if not isinstance(num_beams, int) or num_beams <= 1:
             raise ValueError(
@@ -498,9 +690,32 @@ class ConstrainedBeamSearchScorer(BeamScorer):
                 f" divisible by `num_beam_groups`, but is {num_beam_groups} with `num_beams` being {num_beams}."
             )
 
+        if advance_budget is not None and (not isinstance(advance_budget, int) or advance_budget <= 0):
+            raise ValueError(
+                f"`advance_budget` has to be a strictly positive integer or `None`, but is {advance_budget}."
+            )
+
+        # logits processors following the beams of this scorer until `finalize`
+        self._attached_processors = []
+        for processor in list(self._processors_to_attach):
+            if any(processor.constraint is constraint for constraint in constraints):
+                processor.scorer = self
+                self._attached_processors.append(processor)
+
+    @classmethod
+    def attach_on_init(cls, processor):
+        """
+        Has every scorer built from now on with `processor.constraint` among its constraints set itself as
+        `processor.scorer` until its `finalize`, which sets it back to `None`. This is how a logits processor (see
+        [`TemplateConstraintLogitsProcessor`]) follows the beams of the scorer that
+        [`~generation.GenerationMixin.generate`] builds when the constraint is passed to it in `constraints`. The
+        processor is only weakly referenced.
+        """
+        cls._processors_to_attach.add(processor)
+
     @property
     def is_done(self) -> bool:
-        return self._done.all()
+        return all(self._host_done)
 
     def make_constraint_states(self, n):
         return [ConstraintListState([constraint.copy() for constraint in self.constraints]) for _ in range(n)]
@@ -510,6 +725,131 @@ class ConstrainedBeamSearchScorer(BeamScorer):
         new_state.reset(sequence)
         return new_state.completed
 
+    def init_beam_states(self, input_ids: torch.LongTensor):
+        if self._compiled_constraints is not None:
+            return self._compiled_constraints.initial_states(input_ids)
+
+        # all the beams of a batch item share the same prompt, so it only needs to be replayed once per batch item
+        beam_states = []
+        for batch_idx in range(len(self._beam_hyps)):
+            prompt_state = self.make_constraint_states(1)[0]
+            prompt_state.reset(input_ids[batch_idx * self.num_beams].tolist())
+            beam_states.extend(prompt_state.copy(stateful=True) for _ in range(self.num_beams))
+        return beam_states
+
+    def init_beam_seq_ids(self, input_ids: torch.LongTensor) -> torch.LongTensor:
+        """
+        Returns, for each beam, the index of the first beam of its batch item that holds the same sequence.
+        """
+        input_ids = input_ids.view(len(self._beam_hyps), self.num_beams, -1)
+        is_same_seq = (input_ids.unsqueeze(2) == input_ids.unsqueeze(1)).all(dim=-1)
+        batch_offsets = torch.arange(len(self._beam_hyps), device=input_ids.device).unsqueeze(-1) * self.num_beams
+        return (is_same_seq.int().argmax(dim=-1) + batch_offsets).view(-1)
+
+    def step_beam_states(
+        self, beam_indices: Union[torch.LongTensor, List[int]], tokens: Union[torch.LongTensor, List[int]]
+    ):
+        """
+        Returns the constraint states of the hypotheses made by appending `tokens` to the beams at `beam_indices`.
+        Without compiled constraints, both can be given as lists to avoid bringing them to the host.
+        """
+        if self._compiled_constraints is not None:
+            return self._compiled_constraints.step(self._beam_states[beam_indices], tokens)
+
+        if isinstance(beam_indices, torch.Tensor):
+            beam_indices, tokens = beam_indices.tolist(), tokens.tolist()
+        new_states = []
+        for beam_index, token in zip(beam_indices, tokens):
+            new_state = self._beam_states[beam_index].copy(stateful=True)
+            new_state.add(token)
+            new_states.append(new_state)
+        return new_states
+
+    def get_beam_completed(self, beam_indices: List[int]) -> List[bool]:
+        """
+        Returns, for each beam in `beam_indices`, whether it fulfilled all the constraints.
+        """
+        if self._compiled_constraints is not None:
+            return self._compiled_constraints.get_completed(self._beam_states[beam_indices]).tolist()
+
+        return [self._beam_states[beam_index].completed for beam_index in beam_indices]
+
+    def get_remaining_steps(self, beam_states, device: torch.device) -> torch.LongTensor:
+        """
+        Returns the least number of tokens each of `beam_states` needs to fulfill all the constraints (see
+        [`ConstraintListState.remaining_steps`]), on `device`.
+        """
+        if self._compiled_constraints is not None:
+            return self._compiled_constraints.get_remaining_steps(beam_states)
+        return torch.tensor([state.remaining_steps() for state in beam_states], dtype=torch.long, device=device)
+
+    def get_beam_advances(self, start: int, end: int, host_beam_states: Optional[list] = None):
+        """
+        Returns, for each beam from `start` to `end`, whether it fulfilled all the constraints and the tokens that
+        would advance it (see [`ConstraintListState.advance`]). `host_beam_states` is a copy of the compiled
+        `self._beam_states` already brought to the host.
+        """
+        if self._compiled_constraints is not None:
+            beam_states = self._beam_states if host_beam_states is None else host_beam_states
+            return self._compiled_constraints.get_advances(beam_states[start:end])
+
+        return [(state.completed, state.advance()) for state in self._beam_states[start:end]]
+
+    def get_beam_advance_tokens(
+        self, input_ids: torch.LongTensor
+    ) -> Tuple[torch.LongTensor, torch.BoolTensor, torch.BoolTensor]:
+        """
+        Returns, for each of the current beams `input_ids`, the tokens that would advance its constraints padded with
+        -1, of shape `(batch_size * num_beams, max_tokens)`, whether any token would advance them, and whether it
+        fulfilled all the constraints, as tensors on the device of `input_ids`. This is how logits processors (see
+        [`TemplateConstraintLogitsProcessor`]) follow the progress of every beam before the next step is scored.
+        """
+        if self._beam_states is None:
+            self._beam_states = self.init_beam_states(input_ids)
+            self._beam_seq_ids = self.init_beam_seq_ids(input_ids)
+
+        if isinstance(self._compiled_constraints, ConstraintDFA):
+            advance_tokens, advance_any = self._compiled_constraints.get_advance_tokens(self._beam_states)
+            return advance_tokens, advance_any, self._compiled_constraints.get_completed(self._beam_states)
+
+        beam_advances = self.get_beam_advances(0, input_ids.shape[0])
+        tokens = [[token for token in advance or [] if token is not WILDCARD] for _, advance in beam_advances]
+        max_tokens = max(len(beam_tokens) for beam_tokens in tokens)
+        device_values = _to_device(
+            {
+                "advance_tokens": [
+                    token for beam_tokens in tokens for token in beam_tokens + [-1] * (max_tokens - len(beam_tokens))
+                ],
+                "advance_any": [advance is not None and WILDCARD in advance for _, advance in beam_advances],
+                "completed": [completed for completed, _ in beam_advances],
+            },
+            input_ids.device,
+        )
+        return (
+            device_values["advance_tokens"].view(len(tokens), max_tokens),
+            device_values["advance_any"].bool(),
+            device_values["completed"].bool(),
+        )
+
+    def get_host_inputs(
+        self, vocab_scores: torch.FloatTensor, sent_beam_tokens: torch.LongTensor, sent_beam_indices: torch.LongTensor
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Returns the tensors that [`~ConstrainedBeamSearchScorer.step_sentence_constraint`] reads on the host, so that
+        they can be brought over together with anything else the step needs.
+        """
+        host_inputs = {
+            "beam_seq_ids": self._beam_seq_ids,
+            "topk_parents": sent_beam_indices,
+            "topk_tokens": sent_beam_tokens,
+        }
+        if self._compiled_constraints is not None:
+            host_inputs["beam_states"] = self._beam_states
+            if self._compiled_constraints.has_wildcard:
+                # the most likely tokens stand for the `WILDCARD` of `ConstraintListState.advance`
+                host_inputs["wildcard_tokens"] = vocab_scores.topk(self.num_beams, dim=-1).indices
+        return host_inputs
+
     def process(
         self,
         input_ids: torch.LongTensor,
@@ -578,87 +918,163 @@ class ConstrainedBeamSearchScorer(BeamScorer):
 
         device = input_ids.device
 
-        next_beam_scores = torch.zeros((batch_size, self.group_size), dtype=next_scores.dtype, device=device)
-        next_beam_tokens = torch.zeros((batch_size, self.group_size), dtype=next_tokens.dtype, device=device)
-        next_beam_indices = torch.zeros((batch_size, self.group_size), dtype=next_indices.dtype, device=device)
-
         if eos_token_id is not None and not isinstance(eos_token_id, torch.Tensor):
             if isinstance(eos_token_id, int):
                 eos_token_id = [eos_token_id]
             eos_token_id = torch.tensor(eos_token_id)
 
+        if self._beam_states is None:
+            self._beam_states = self.init_beam_states(input_ids)
+            self._beam_seq_ids = self.init_beam_seq_ids(input_ids)
+
+        done = self._host_done
         for batch_idx, beam_hyp in enumerate(self._beam_hyps):
-            if self._done[batch_idx]:
+            if done[batch_idx]:
                 if self.num_beams < len(beam_hyp):
                     raise ValueError(f"Batch can only be done if at least {self.num_beams} beams have been generated")
                 if eos_token_id is None or pad_token_id is None:
                     raise ValueError("Generated beams >= num_beams -> eos_token_id and pad_token have to be defined")
-                # pad the batch
-                next_beam_scores[batch_idx, :] = 0
-                next_beam_tokens[batch_idx, :] = pad_token_id
-                next_beam_indices[batch_idx, :] = 0
+
+        # the candidates of all the batch items are handled at once: the first `group_size` ones that are not eos
+        # become the next beams, and the eos ones among the top `group_size` are finished hypotheses
+        if eos_token_id is not None:
+            is_eos = torch.isin(next_tokens, eos_token_id.to(device))
+        else:
+            is_eos = torch.zeros_like(next_tokens, dtype=torch.bool)
+        beam_token_rank = torch.arange(next_tokens.shape[-1], device=device)
+        is_finished = is_eos & (beam_token_rank < self.group_size) & ~self._done.unsqueeze(-1)
+        batch_beam_indices = next_indices + torch.arange(batch_size, device=device).unsqueeze(-1) * self.group_size
+
+        next_beam_columns = is_eos.int().sort(dim=-1, stable=True).indices[:, : self.group_size]
+        next_beam_scores = next_scores.gather(-1, next_beam_columns)
+        next_beam_tokens = next_tokens.gather(-1, next_beam_columns)
+        next_beam_indices = batch_beam_indices.gather(-1, next_beam_columns)
+
+        if any(done):
+            # pad the batch
+            is_done = self._done.unsqueeze(-1)
+            next_beam_scores = next_beam_scores.masked_fill(is_done, 0)
+            next_beam_tokens = next_beam_tokens.masked_fill(is_done, pad_token_id)
+            next_beam_indices = next_beam_indices.masked_fill(is_done, 0)
+
+        # the host only needs the finished hypotheses, a couple of numbers per batch item and what the constraints are
+        # stepped with, which are all brought over at once
+        host_values = {
+            "is_finished": is_finished,
+            "next_scores": next_scores,
+            "batch_beam_indices": batch_beam_indices,
+            "num_beam_tokens": (~is_eos).sum(dim=-1),
+            "best_scores": next_scores.max(dim=-1).values,
+        }
+        if self._compiled_constraints is not None:
+            # the live state of the beam that eos is appended to already knows whether the constraints are fulfilled
+            host_values["completes_constraints"] = self._compiled_constraints.get_completed(
+                self._beam_states[batch_beam_indices]
+            )
+        if self.prune_infeasible_beams:
+            # a beam that needs more tokens than it has left can't fulfill the constraints, and neither can any beam
+            # extending it
+            is_feasible = self.get_remaining_steps(self._beam_states, device) <= self.max_length - input_ids.shape[-1]
+            host_values["has_feasible_beams"] = is_feasible.view(batch_size, self.group_size).any(dim=-1)
+            host_values["next_beam_scores"] = next_beam_scores
+        if self.constraint_aware_early_stopping:
+            # only the candidates that fulfill all the constraints, or still can in time, may become kept hypotheses
+            if self._compiled_constraints is not None:
+                next_states = self.step_beam_states(batch_beam_indices, next_tokens)
+                can_be_kept = self._compiled_constraints.get_completed(next_states)
+                is_open = ~is_eos
+                if self.max_length is not None:
+                    remaining_steps = self._compiled_constraints.get_remaining_steps(next_states)
+                    is_open &= remaining_steps <= self.max_length - cur_len
+                can_be_kept |= is_open
+                host_values["best_attainable_scores"] = next_scores.masked_fill(~can_be_kept, -float("inf")).max(
+                    dim=-1
+                ).values
+            else:
+                host_values["next_tokens"] = next_tokens
+                host_values["is_eos"] = is_eos
+        host_values.update(self.get_host_inputs(scores_for_all_vocab, next_beam_tokens, next_beam_indices))
+        host_values = _to_host(host_values)
+
+        active_batch_indices = []
+        for batch_idx, beam_hyp in enumerate(self._beam_hyps):
+            if done[batch_idx]:
                 continue
 
-            # next tokens for this sentence.
-            beam_idx = 0
-            for beam_token_rank, (next_token, next_score, next_index) in enumerate(
-                zip(next_tokens[batch_idx], next_scores[batch_idx], next_indices[batch_idx])
-            ):
-                batch_beam_idx = batch_idx * self.group_size + next_index
+            for beam_token_rank in range(self.group_size):
                 # add to generated hypotheses if end of sentence
-                if (eos_token_id is not None) and (next_token.item() in eos_token_id):
-                    # if beam_token does not belong to top num_beams tokens, it should not be added
-                    is_beam_token_worse_than_top_num_beams = beam_token_rank >= self.group_size
-                    if is_beam_token_worse_than_top_num_beams:
-                        continue
+                if not host_values["is_finished"][batch_idx][beam_token_rank]:
+                    continue
 
-                    completes_constraint = self.check_completes_constraints(input_ids[batch_beam_idx].cpu().tolist())
-                    if completes_constraint:
-                        if beam_indices is not None:
-                            beam_index = beam_indices[batch_beam_idx]
-                            beam_index = beam_index + (batch_beam_idx,)
-                        else:
-                            beam_index = None
-
-                        beam_hyp.add(
-                            input_ids[batch_beam_idx].clone(),
-                            next_score.item(),
-                            beam_indices=beam_index,
-                            generated_len=cur_len - decoder_prompt_len,
-                        )
+                batch_beam_idx = host_values["batch_beam_indices"][batch_idx][beam_token_rank]
+                if self._compiled_constraints is not None:
+                    completes_constraint = host_values["completes_constraints"][batch_idx][beam_token_rank]
                 else:
-                    # add next predicted token since it is not eos_token
-                    next_beam_scores[batch_idx, beam_idx] = next_score
-                    next_beam_tokens[batch_idx, beam_idx] = next_token
-                    next_beam_indices[batch_idx, beam_idx] = batch_beam_idx
-                    beam_idx += 1
-
-                # once the beam for next step is full, don't add more tokens to it.
-                if beam_idx == self.group_size:
-                    break
-
-            new_scores, new_tokens, new_indices = self.step_sentence_constraint(
-                batch_idx,
-                input_ids,
-                scores_for_all_vocab,
-                next_beam_scores[batch_idx],
-                next_beam_tokens[batch_idx],
-                next_beam_indices[batch_idx],
-            )
+                    completes_constraint = self.get_beam_completed([batch_beam_idx])[0]
+                if completes_constraint:
+                    if beam_indices is not None:
+                        beam_index = beam_indices[batch_beam_idx]
+                        beam_index = beam_index + (batch_beam_idx,)
+                    else:
+                        beam_index = None
 
-            next_beam_scores[batch_idx] = new_scores
-            next_beam_tokens[batch_idx] = new_tokens
-            next_beam_indices[batch_idx] = new_indices
+                    beam_hyp.add(
+                        input_ids[batch_beam_idx].clone(),
+                        host_values["next_scores"][batch_idx][beam_token_rank],
+                        beam_indices=beam_index,
+                        generated_len=cur_len - decoder_prompt_len,
+                    )
 
-            if beam_idx < self.group_size:
+            if host_values["num_beam_tokens"][batch_idx] < self.group_size:
                 raise ValueError(
                     f"At most {self.group_size} tokens in {next_tokens[batch_idx]} can be equal to `eos_token_id:"
                     f" {eos_token_id}`. Make sure {next_tokens[batch_idx]} are corrected."
                 )
 
+            if (
+                self.prune_infeasible_beams
+                and not host_values["has_feasible_beams"][batch_idx]
+                and eos_token_id is not None
+                and pad_token_id is not None
+            ):
+                # none of the beams can fulfill the constraints anymore, so rather than running until `max_length`
+                # the batch item is finished with its most likely hypotheses, like `finalize` would do
+                for beam_token_rank in range(self.num_beam_hyps_to_keep - len(beam_hyp)):
+                    batch_beam_idx = host_values["topk_parents"][batch_idx][beam_token_rank]
+                    next_token = input_ids.new_tensor([host_values["topk_tokens"][batch_idx][beam_token_rank]])
+                    beam_index = None
+                    if beam_indices is not None:
+                        beam_index = beam_indices[batch_beam_idx] + (batch_beam_idx,)
+                    beam_hyp.add(
+                        torch.cat([input_ids[batch_beam_idx], next_token]),
+                        host_values["next_beam_scores"][batch_idx][beam_token_rank],
+                        beam_indices=beam_index,
+                        generated_len=cur_len - decoder_prompt_len,
+                    )
+                self._done[batch_idx] = True
+                self._host_done[batch_idx] = True
+                continue
+
+            active_batch_indices.append(batch_idx)
+
             # Check if we are done so that we can save a pad step if all(done)
-            self._done[batch_idx] = self._done[batch_idx] or beam_hyp.is_done(
-                next_scores[batch_idx].max().item(), cur_len, decoder_prompt_len
+            best_score = host_values["best_scores"][batch_idx]
+            if self.constraint_aware_early_stopping and len(beam_hyp) >= beam_hyp.num_beams:
+                best_score = self.get_best_attainable_score(batch_idx, host_values, cur_len)
+            if beam_hyp.is_done(best_score, cur_len, decoder_prompt_len):
+                self._done[batch_idx] = True
+                self._host_done[batch_idx] = True
+
+        if len(active_batch_indices) > 0:
+            # the batch items that were not done before this step get their constraints pushed forward all at once
+            next_beam_scores, next_beam_tokens, next_beam_indices = self.step_sentence_constraint(
+                active_batch_indices,
+                input_ids,
+                scores_for_all_vocab,
+                next_beam_scores,
+                next_beam_tokens,
+                next_beam_indices,
+                host_inputs=host_values,
             )
 
         return UserDict(
@@ -669,18 +1085,75 @@ class ConstrainedBeamSearchScorer(BeamScorer):
             }
         )
 
+    def get_best_attainable_score(self, batch_idx: int, host_values: Dict[str, list], cur_len: int) -> float:
+        """
+        Returns the best score among the candidates of `batch_idx` of length `cur_len` that may still become kept
+        hypotheses: those that fulfill all the constraints once their token is appended, and those that are not eos
+        and can still fulfill them within `max_length`. Returns `-inf` if there are none.
+        """
+        if "best_attainable_scores" in host_values:
+            return host_values["best_attainable_scores"][batch_idx]
+
+        next_states = self.step_beam_states(
+            host_values["batch_beam_indices"][batch_idx], host_values["next_tokens"][batch_idx]
+        )
+        attainable_scores = [
+            score
+            for score, state, is_eos in zip(
+                host_values["next_scores"][batch_idx], next_states, host_values["is_eos"][batch_idx]
+            )
+            if state.completed
+            or (
+                not is_eos
+                and (self.max_length is None or state.remaining_steps() <= self.max_length - cur_len)
+            )
+        ]
+        return max(attainable_scores, default=-float("inf"))
+
+    def select_advance_tokens(
+        self, advance_tokens: Dict[int, List[int]], vocab_scores: torch.FloatTensor
+    ) -> Dict[int, List[int]]:
+        """
+        Keeps, for every beam of `advance_tokens` proposing more than `self.advance_budget` tokens, only the
+        `self.advance_budget` most likely ones according to `vocab_scores`, in the order they were proposed. All the
+        beams over budget are ranked with a single `topk` over their padded tokens, the padding always ranking last.
+        """
+        over_budget = [beam for beam, tokens in advance_tokens.items() if len(tokens) > self.advance_budget]
+        if len(over_budget) == 0:
+            return advance_tokens
+
+        width = max(len(advance_tokens[beam]) for beam in over_budget)
+        padded = [
+            token for beam in over_budget for token in advance_tokens[beam] + [-1] * (width - len(advance_tokens[beam]))
+        ]
+        device_values = _to_device({"beams": over_budget, "tokens": padded}, vocab_scores.device)
+        tokens = device_values["tokens"].view(len(over_budget), width)
+        scores = vocab_scores[device_values["beams"][:, None], tokens.clamp(min=0)]
+        # tokens already banned by a logits processor score -inf too, so the padding is ranked strictly below them
+        lowest_score = torch.finfo(scores.dtype).min
+        scores = scores.nan_to_num(nan=lowest_score, neginf=lowest_score).masked_fill(tokens < 0, -float("inf"))
+        kept = scores.topk(self.advance_budget, dim=-1).indices.sort(dim=-1).values
+        kept = _to_host({"kept": kept})["kept"]
+
+        advance_tokens = dict(advance_tokens)
+        for beam, cols in zip(over_budget, kept):
+            advance_tokens[beam] = [advance_tokens[beam][col] for col in cols]
+        return advance_tokens
+
     def step_sentence_constraint(
         self,
-        batch_idx: int,
+        batch_indices: List[int],
         input_ids: torch.LongTensor,
         vocab_scores: torch.FloatTensor,
         sent_beam_scores: torch.FloatTensor,
         sent_beam_tokens: torch.LongTensor,
         sent_beam_indices: torch.LongTensor,
         push_progress: bool = False,
+        host_inputs: Optional[Dict[str, list]] = None,
     ):
-        # sent_beam_tokens are the next {num_beams} number of tokens that are under consideration for this beam
-        # (candidate next tokens)
+        # sent_beam_tokens are the next {num_beams} number of tokens that are under consideration for each of the batch
+        # items (candidate next tokens), of shape `(batch_size, num_beams)`. Only the batch items in `batch_indices`
+        # are stepped, the others are returned as they are.
 
         # 1. Adding "advance_tokens"
         #     using ConstraintStateList.advance(), we propose new tokens to be added into this "candidate list" that will
@@ -689,128 +1162,204 @@ class ConstrainedBeamSearchScorer(BeamScorer):
         # 2. Selecting best candidates such that we end up with highest probable candidates
         #     that fulfill our constraints.
 
-        orig_len = sent_beam_indices.size(0)
+        num_sents, orig_len = sent_beam_indices.shape
         device = sent_beam_indices.device
 
-        # initialize states
-        topk_contraint_states = self.make_constraint_states(orig_len)
-        advance_constraint_states = self.make_constraint_states(orig_len)
+        # every decision below is taken on the host, from values brought over with a single synchronization
+        if host_inputs is None:
+            host_inputs = _to_host(self.get_host_inputs(vocab_scores, sent_beam_tokens, sent_beam_indices))
+
+        # initialize states: `self._beam_states` already holds the state of every `pre_seq`, so the (topk) hypotheses
+        # only need to step their parent's state by the one token they append.
+        if self._compiled_constraints is not None:
+            topk_contraint_states = self.step_beam_states(sent_beam_indices.view(-1), sent_beam_tokens.view(-1))
+        else:
+            topk_contraint_states = self.step_beam_states(
+                [parent for row in host_inputs["topk_parents"] for parent in row],
+                [token for row in host_inputs["topk_tokens"] for token in row],
+            )
 
-        sidx, eidx = batch_idx * orig_len, (batch_idx + 1) * orig_len
-        this_batch_input_ids = input_ids[sidx:eidx]
-        this_batch_token_scores = vocab_scores[sidx:eidx]
-        full_hypotheses = torch.cat((input_ids[sent_beam_indices], sent_beam_tokens.unsqueeze(-1)), dim=-1)
+        # a hypothesis is identified by the sequence it extends and the token it appends, so that duplicates are
+        # spotted without materializing full sequences
+        beam_seq_ids = host_inputs["beam_seq_ids"]
+        topk_parents, topk_tokens = host_inputs["topk_parents"], host_inputs["topk_tokens"]
+        wildcard_tokens = host_inputs.get("wildcard_tokens")
 
         # need to make new hypothesis that advance the constraints
         track_new = {
-            "new_seqs": full_hypotheses.tolist(),
-            "new_states": [],
+            "new_rows": [],
+            "new_cols": [],
             "new_indices": [],
             "new_tokens": [],
-            "new_scores": [],
         }
-        for seq_idx, pre_seq in enumerate(this_batch_input_ids):
-            # pre_seq = ith sequence generated before this step.
-
-            # input_ids -> (topk) generic beam search best model next tokens
-            #           -> (advance) constraints forcing the next token
-            # either way, we need to sort them into "banks" later, so store a "ConstraintListState" for all types of
-            # hypotheses.
-
-            topk_state = topk_contraint_states[seq_idx]
-            topk_state.reset(full_hypotheses[seq_idx].cpu().tolist())
+        num_new = [0] * num_sents
+        # tokens proposed to advance the constraints of each uncompleted `pre_seq`, indexed across all the batches
+        advance_tokens = {}
+        batch_completed = {}
+        for batch_idx in batch_indices:
+            sidx, eidx = batch_idx * orig_len, (batch_idx + 1) * orig_len
+            beam_advances = self.get_beam_advances(sidx, eidx, host_inputs.get("beam_states"))
+            batch_completed[batch_idx] = [completed for completed, _ in beam_advances]
+            for seq_idx, (completed, advance_state_raw) in enumerate(beam_advances):
+                if completed or advance_state_raw is None or len(advance_state_raw) == 0:
+                    continue
+                if WILDCARD in advance_state_raw:
+                    # any token makes progress, but at most `orig_len` of them can survive the selection below, so
+                    # only the most likely ones are proposed instead of the whole vocabulary
+                    advance_state_raw = [token for token in advance_state_raw if token is not WILDCARD]
+                    if wildcard_tokens is not None:
+                        advance_state_raw += wildcard_tokens[sidx + seq_idx]
+                    else:
+                        advance_state_raw += vocab_scores[sidx + seq_idx].topk(orig_len).indices.tolist()
+                advance_tokens[sidx + seq_idx] = advance_state_raw
+        if self.advance_budget is not None:
+            advance_tokens = self.select_advance_tokens(advance_tokens, vocab_scores)
+
+        for batch_idx in batch_indices:
+            sidx = batch_idx * orig_len
+            new_seqs = {
+                (beam_seq_ids[parent], token) for parent, token in zip(topk_parents[batch_idx], topk_tokens[batch_idx])
+            }
 
-            advance_state = advance_constraint_states[seq_idx]
-            advance_state.reset(pre_seq.cpu().tolist())
+            def add_hypothesis(seq_idx, token):
+                # every batch item gets its (topk) hypotheses followed by its (advance) ones
+                new_seqs.add((beam_seq_ids[sidx + seq_idx], token))
+                track_new["new_rows"].append(batch_idx)
+                track_new["new_cols"].append(orig_len + num_new[batch_idx])
+                track_new["new_indices"].append(sidx + seq_idx)  # idx -> global idx across all the batches
+                track_new["new_tokens"].append(token)
+                num_new[batch_idx] += 1
+
+            for seq_idx in range(orig_len):
+                # seq_idx = ith sequence generated before this step.
+
+                # input_ids -> (topk) generic beam search best model next tokens
+                #           -> (advance) constraints forcing the next token
+                # either way, we need to sort them into "banks" later, so keep track of the constraint states of all
+                # types of hypotheses.
+
+                pre_seq_id = beam_seq_ids[sidx + seq_idx]
+
+                if not batch_completed[batch_idx][seq_idx]:
+                    for advance_token in advance_tokens.get(sidx + seq_idx, []):
+                        # since adding each `advance_token` leads to a different hypothesis, it gets its own state below.
+                        if (pre_seq_id, advance_token) not in new_seqs:
+                            # prevent duplicates, which are basically bound to happen in this process.
+                            add_hypothesis(seq_idx, advance_token)
+                elif push_progress:
+                    # Basically, `sent_beam_indices` often chooses very little among `input_ids` the generated sequences
+                    # that actually fulfill our constraints. For example, let constraints == ["loves pies"] and
+
+                    #     pre_seq_1 = "The child loves pies and" pre_seq_2 = "The child plays in the playground and"
+
+                    # Without this step, if `sent_beam_indices` is something like [1,1], then
+                    #     1. `pre_seq_1` won't be added to the list of (topk) hypothesis since it's not in the indices and
+                    #     2.  it won't be added to the list of (advance) hypothesis since it's completed already. (this
+                    #         is the else part of `if constraints_completed[seq_idx]`)
+                    #     3. it ends up simply getting removed from consideration.
+
+                    # #3 might be fine and actually desired, since it's likely that it's a low-probability output
+                    # anyways, especially if it's not in the list of `sent_beam_indices`. But this often leads to
+                    # lengthened beam search times, since completed sequences keep getting removed after all this effort
+                    # for constrained generation.
+
+                    # Here, we basically take `pre_seq_1` and to "push" it into the considered list of hypotheses, by
+                    # simply appending the next likely token in the vocabulary and adding it to the list of hypotheses.
+
+                    new_token = vocab_scores[sidx + seq_idx].argmax().item()  # some next probable token
+
+                    if (pre_seq_id, new_token) not in new_seqs:
+                        # but still don't want to have duplicates
+                        add_hypothesis(seq_idx, new_token)
+
+        if len(track_new["new_indices"]) == 0 and not self.prune_infeasible_beams:
+            next_states = topk_contraint_states
+        else:
+            new_on_host = track_new
+            track_new = _to_device(dict(track_new, has_new=[int(count > 0) for count in num_new]), device)
+            new_rows, new_cols = track_new["new_rows"], track_new["new_cols"]
+            new_indices, new_tokens = track_new["new_indices"], track_new["new_tokens"]
+            new_scores = vocab_scores[new_indices, new_tokens]
+            if self._compiled_constraints is not None:
+                new_states = self.step_beam_states(new_indices, new_tokens)
+            else:
+                new_states = self.step_beam_states(new_on_host["new_indices"], new_on_host["new_tokens"])
+
+            # pad every batch item up to the largest pool
+            pool_size = orig_len + max(num_new)
+            all_scores = sent_beam_scores.new_full((num_sents, pool_size), -float("inf"))
+            all_tokens = sent_beam_tokens.new_zeros((num_sents, pool_size))
+            all_indices = sent_beam_indices.new_zeros((num_sents, pool_size))
+            is_valid = torch.zeros((num_sents, pool_size), dtype=torch.bool, device=device)
+            for pool, topk, new in (
+                (all_scores, sent_beam_scores, new_scores),
+                (all_tokens, sent_beam_tokens, new_tokens),
+                (all_indices, sent_beam_indices, new_indices),
+                (is_valid, True, True),
+            ):
+                pool[:, :orig_len] = topk
+                pool[new_rows, new_cols] = new
+
+            if self._compiled_constraints is not None:
+                state_shape = topk_contraint_states.shape[1:]
+                all_states = topk_contraint_states.new_zeros((num_sents, pool_size) + state_shape)
+                all_states[:, :orig_len] = topk_contraint_states.view((num_sents, orig_len) + state_shape)
+                all_states[new_rows, new_cols] = new_states
+                all_banks = self._compiled_constraints.get_banks(all_states)
+            else:
+                all_states = [
+                    topk_contraint_states[batch_idx * orig_len : (batch_idx + 1) * orig_len]
+                    for batch_idx in range(num_sents)
+                ]
+                for row, state in zip(new_on_host["new_rows"], new_states):
+                    all_states[row].append(state)
+                all_banks = torch.tensor(
+                    [[one.get_bank() for one in row] + [0] * (pool_size - len(row)) for row in all_states],
+                    device=device,
+                )
 
-            if not advance_state.completed:
-                advance_state_raw = advance_state.advance()
-                if advance_state_raw is None or len(advance_state_raw) == 0:
-                    continue
-                advance_long = torch.LongTensor(advance_state_raw)
-                advance_tokens = advance_long.to(device)
-                for advance_token in advance_tokens:
-                    # since adding each `advance_token` leads to a different hypothesis, create new state instance.
-                    new_state = advance_state.copy(stateful=True)
-                    new_state.add(advance_token.cpu().tolist())
-
-                    advance_seq = torch.cat((pre_seq, advance_token.unsqueeze(0)), -1).cpu().tolist()
-                    if advance_seq not in track_new["new_seqs"]:
-                        # prevent duplicates, which are basically bound to happen in this process.
-                        track_new["new_seqs"].append(advance_seq)
-                        track_new["new_indices"].append(sidx + seq_idx)  # idx -> global idx across all the batches
-                        track_new["new_tokens"].append(advance_token)
-                        track_new["new_scores"].append(this_batch_token_scores[seq_idx].take(advance_token))
-                        track_new["new_states"].append(new_state)
-            elif push_progress:
-                # Basically, `sent_beam_indices` often chooses very little among `input_ids` the generated sequences that
-                # actually fulfill our constraints. For example, let constraints == ["loves pies"] and
-
-                #     pre_seq_1 = "The child loves pies and" pre_seq_2 = "The child plays in the playground and"
-
-                # Without this step, if `sent_beam_indices` is something like [1,1], then
-                #     1. `pre_seq_1` won't be added to the list of (topk) hypothesis since it's not in the indices and
-                #     2.  it won't be added to the list of (advance) hypothesis since it's completed already. (this is
-                #         the else part of `if constraints_completed[seq_idx]`)
-                #     3. it ends up simply getting removed from consideration.
-
-                # #3 might be fine and actually desired, since it's likely that it's a low-probability output anyways,
-                # especially if it's not in the list of `sent_beam_indices`. But this often leads to lengthened beam
-                # search times, since completed sequences keep getting removed after all this effort for constrained
-                # generation.
-
-                # Here, we basically take `pre_seq_1` and to "push" it into the considered list of hypotheses, by simply
-                # appending the next likely token in the vocabulary and adding it to the list of hypotheses.
-
-                new_score, new_token = torch.max(this_batch_token_scores[seq_idx], 0)  # some next probable token
-                advance_seq = torch.cat((pre_seq, new_token.unsqueeze(0)), -1)
-
-                advance_state = advance_constraint_states[seq_idx]
-
-                advance_seq = advance_seq.cpu().tolist()
-
-                advance_state.reset(advance_seq)
-                if advance_seq not in track_new["new_seqs"]:
-                    # but still don't want to have duplicates
-                    track_new["new_seqs"].append(advance_seq)
-                    track_new["new_indices"].append(seq_idx)
-                    track_new["new_tokens"].append(new_token)
-                    track_new["new_scores"].append(new_score)
-                    track_new["new_states"].append(advance_state)
-
-        if len(track_new["new_indices"]) > 0:
-            new_indices = torch.tensor(track_new["new_indices"]).to(device)
-            new_tokens = torch.stack(track_new["new_tokens"]).to(device)
-            new_scores = torch.stack(track_new["new_scores"]).to(device)
-
-            all_states = topk_contraint_states + track_new["new_states"]
-            all_tokens = torch.cat((sent_beam_tokens, new_tokens), -1)
-            all_scores = torch.cat((sent_beam_scores, new_scores), -1)
-            all_banks = torch.tensor([one.get_bank() for one in all_states]).to(device)
-
-            zipped = all_banks * 100 + all_scores
-            indices = zipped.sort(descending=True).indices
-            sorted_banks = all_banks[indices]
-
-            # Then we end up with {sorted among bank C}, {sorted among bank C-1}, ..., {sorted among bank 0}
-
-            counter = -1
-            cur_bank = sorted_banks[0]
-            increments = []
-            for bank in sorted_banks:
-                if bank == cur_bank:
-                    counter += 1
+            is_demoted = None
+            reselect = track_new["has_new"].bool()
+            if self.prune_infeasible_beams:
+                if self._compiled_constraints is not None:
+                    all_remaining = self._compiled_constraints.get_remaining_steps(all_states)
                 else:
-                    counter = 0
-                    cur_bank = bank
-                increments.append(counter)
-            rearrangers = torch.tensor(np.argsort(increments, kind="mergesort"))
+                    all_remaining = torch.tensor(
+                        [[one.remaining_steps() for one in row] + [0] * (pool_size - len(row)) for row in all_states],
+                        device=device,
+                    )
+                # hypotheses that can't fulfill the constraints within `max_length` only fill the beams left over
+                is_demoted = all_remaining > self.max_length - (input_ids.shape[-1] + 1)
+                reselect = reselect | (is_demoted & is_valid).any(dim=-1)
+
+            indices = select_by_bank(all_banks, all_scores, is_valid, orig_len, is_demoted=is_demoted)
+            # batch items without (advance) hypotheses keep their (topk) hypotheses as they are
+            indices = torch.where(
+                reselect.unsqueeze(-1),
+                indices,
+                torch.arange(orig_len, device=device).expand(num_sents, -1),
+            )
 
-            indices = indices[rearrangers][:orig_len]
+            sent_beam_scores = all_scores.gather(-1, indices)
+            sent_beam_tokens = all_tokens.gather(-1, indices)
+            sent_beam_indices = all_indices.gather(-1, indices)
+            if self._compiled_constraints is not None:
+                next_states = all_states[torch.arange(num_sents, device=device).unsqueeze(-1), indices].flatten(0, 1)
+            else:
+                next_states = [row[idx] for row, row_indices in zip(all_states, indices.tolist()) for idx in row_indices]
 
-            sent_beam_scores = all_scores[indices]
-            sent_beam_tokens = all_tokens[indices]
-            sent_beam_indices = torch.cat((sent_beam_indices, new_indices))[indices]
+        # the selected hypotheses become the beams of the next step, so their states are carried over in the same
+        # order. Two of them hold the same sequence if they extend the same sequence with the same token.
+        parent_seq_ids = self._beam_seq_ids[sent_beam_indices]
+        is_same_seq = (parent_seq_ids.unsqueeze(-1) == parent_seq_ids.unsqueeze(-2)) & (
+            sent_beam_tokens.unsqueeze(-1) == sent_beam_tokens.unsqueeze(-2)
+        )
+        batch_offsets = torch.arange(num_sents, device=device).unsqueeze(-1) * orig_len
+        next_seq_ids = (is_same_seq.int().argmax(dim=-1) + batch_offsets).view(-1)
+        for batch_idx in batch_indices:
+            sidx, eidx = batch_idx * orig_len, (batch_idx + 1) * orig_len
+            self._beam_states[sidx:eidx] = next_states[sidx:eidx]
+            self._beam_seq_ids[sidx:eidx] = next_seq_ids[sidx:eidx]
 
         return sent_beam_scores, sent_beam_tokens, sent_beam_indices
 
@@ -828,6 +1377,11 @@ class ConstrainedBeamSearchScorer(BeamScorer):
     ) -> Tuple[torch.LongTensor]:
         batch_size = len(self._beam_hyps)
 
+        # the search is over, so the processors attached on init no longer follow its beams
+        for processor in self._attached_processors:
+            if processor.scorer is self:
+                processor.scorer = None
+
         if eos_token_id is not None and not isinstance(eos_token_id, torch.Tensor):
             if isinstance(eos_token_id, int):
                 eos_token_id = [eos_token_id]
@@ -835,19 +1389,25 @@ class ConstrainedBeamSearchScorer(BeamScorer):
 
         # finalize all open beam hypotheses and add to generated hypotheses
         for batch_idx, beam_hyp in enumerate(self._beam_hyps):
-            if self._done[batch_idx]:
+            if self._host_done[batch_idx]:
                 continue
 
             # all open beam hypotheses are added to the beam hypothesis
             # beam hypothesis class automatically keeps the best beams
 
             ids_collect = []
+            sidx, eidx = batch_idx * self.num_beams, (batch_idx + 1) * self.num_beams
+            if self._beam_states is not None:
+                # `self._beam_states` was carried over to the beams of the last step, which are `input_ids`
+                beams_completed = self.get_beam_completed(list(range(sidx, eidx)))
+            else:
+                beams_completed = [self.check_completes_constraints(tokens) for tokens in input_ids[sidx:eidx].tolist()]
             for beam_id in range(self.num_beams):
                 batch_beam_idx = batch_idx * self.num_beams + beam_id
                 final_score = final_beam_scores[batch_beam_idx].item()
                 final_tokens = input_ids[batch_beam_idx]
 
-                completes_constraint = self.check_completes_constraints(final_tokens.cpu().tolist())
+                completes_constraint = beams_completed[beam_id]
                 if completes_constraint:
                     beam_index = beam_indices[batch_beam_idx] if beam_indices is not None else None
                     generated_len = final_tokens.shape[-1] - decoder_prompt_len
@@ -875,9 +1435,9 @@ class ConstrainedBeamSearchScorer(BeamScorer):
 
         # retrieve best hypotheses
         for i, beam_hyp in enumerate(self._beam_hyps):
-            sorted_hyps = sorted(beam_hyp.beams, key=lambda x: x[0])
+            sorted_hyps = beam_hyp.best(self.num_beam_hyps_to_keep)
             for j in range(self.num_beam_hyps_to_keep):
-                best_hyp_tuple = sorted_hyps.pop()
+                best_hyp_tuple = sorted_hyps[j]
                 best_score = best_hyp_tuple[0]
                 best_hyp = best_hyp_tuple[1]
                 best_index = best_hyp_tuple[2]
@@ -940,7 +1500,10 @@ class BeamHypotheses:
         self.early_stopping = early_stopping
         self.max_length = max_length
         self.num_beams = num_beams
-        self.beams = []
+        # min-heap of `(score, insertion order, hyp, beam_indices)`, so that the worst hypothesis is always on top and
+        # ties are broken in favour of the most recent hypothesis
+        self._heap = []
+        self._num_added = 0
         self.worst_score = 1e9
 
         if not isinstance(self.early_stopping, bool) and self.max_length is None:
@@ -953,7 +1516,20 @@ class BeamHypotheses:
         """
         Number of hypotheses in the list.
         """
-        return len(self.beams)
+        return len(self._heap)
+
+    @property
+    def beams(self) -> List[Tuple[float, torch.LongTensor, Optional[torch.LongTensor]]]:
+        """
+        The `(score, hyp, beam_indices)` hypotheses in the list, in the order they were added.
+        """
+        return [(score, hyp, beam_indices) for score, _, hyp, beam_indices in sorted(self._heap, key=lambda x: x[1])]
+
+    def best(self, n: int) -> List[Tuple[float, torch.LongTensor, Optional[torch.LongTensor]]]:
+        """
+        The `n` best `(score, hyp, beam_indices)` hypotheses in the list, best first.
+        """
+        return [(score, hyp, beam_indices) for score, _, hyp, beam_indices in heapq.nlargest(n, self._heap)]
 
     def add(
         self,
@@ -972,13 +1548,14 @@ class BeamHypotheses:
             score = sum_logprobs / (hyp.shape[-1] ** self.length_penalty)
 
         if len(self) < self.num_beams or score > self.worst_score:
-            self.beams.append((score, hyp, beam_indices))
-            if len(self) > self.num_beams:
-                sorted_next_scores = sorted([(s, idx) for idx, (s, _, _) in enumerate(self.beams)])
-                del self.beams[sorted_next_scores[0][1]]
-                self.worst_score = sorted_next_scores[1][0]
+            hypothesis = (score, self._num_added, hyp, beam_indices)
+            self._num_added += 1
+            if len(self) < self.num_beams:
+                heapq.heappush(self._heap, hypothesis)
             else:
-                self.worst_score = min(score, self.worst_score)
+                # the new hypothesis is better than the worst one, which is evicted
+                heapq.heapreplace(self._heap, hypothesis)
+            self.worst_score = self._heap[0][0]
 
     def is_done(self, best_sum_logprobs: float, cur_len: int, decoder_prompt_len: Optional[int] = 0) -> bool:
         """
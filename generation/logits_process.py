@@ -15,7 +15,7 @@
 
 import inspect
 import math
-from typing import Callable, Iterable, List, Optional, Tuple, Union
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -23,6 +23,7 @@ import torch
 from ..pytorch_utils import isin_mps_friendly
 from ..utils import add_start_docstrings
 from ..utils.logging import get_logger
+from .beam_search import ConstrainedBeamSearchScorer
 
 
 logger = get_logger(__name__)
@@ -45,20 +46,54 @@ LOGITS_PROCESSOR_INPUTS_DOCSTRING = r"""
 class LogitsProcessor:
     """Abstract base class for all logit processors that can be applied during generation."""
 
+    # Whether the processor only changes scores elementwise and implements `process_inplace`, which a fused
+    # `LogitsProcessorList` calls instead of `__call__`.
+    is_inplace = False
+
     @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
         raise NotImplementedError(
             f"{self.__class__} is an abstract class. Only classes inheriting this class can be called."
         )
 
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Same as `__call__`, but writes the processed scores into `scores` and returns them. Only implemented by the
+        processors with `is_inplace` set.
+        """
+        raise NotImplementedError(f"{self.__class__} doesn't process scores in place.")
+
 
 class LogitsProcessorList(list):
     """
     This class can be used to create a list of [`LogitsProcessor`] to subsequently process a `scores` input tensor.
     This class inherits from list and adds a specific *__call__* method to apply each [`LogitsProcessor`] to the
     inputs.
+
+    Args:
+        fused (`bool`, *optional*, defaults to `False`):
+            Whether the processors with `is_inplace` set are run with `process_inplace` on one buffer shared by the
+            whole list, instead of each of them making its own copy of the scores. The scores passed to the list are
+            copied at most once and never modified. [`~generation.GenerationMixin.generate`] builds its own
+            (non-fused) list and copies the processors passed to it over, so this only applies to lists that are
+            called directly, e.g. from a custom decoding loop.
     """
 
+    def __init__(self, *args, fused: bool = False):
+        super().__init__(*args)
+        self.fused = fused
+        # names of the arguments that every processor takes beyond `input_ids` and `scores`, by processor id
+        self._extra_args = {}
+
+    def _get_extra_args(self, processor) -> Tuple[str, ...]:
+        cached = self._extra_args.get(id(processor))
+        # the processor is kept along, so that its id can't be reused by another one
+        if cached is None or cached[0] is not processor:
+            function_args = inspect.signature(processor.__call__).parameters
+            cached = (processor, tuple(function_args.keys())[2:])
+            self._extra_args[id(processor)] = cached
+        return cached[1]
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.FloatTensor:
         r"""
         Args:
@@ -75,17 +110,26 @@ class LogitsProcessorList(list):
                 The processed prediction scores.
 
         """
+        # whether `scores` is a tensor made within this call, that in-place processors may write into
+        owns_scores = False
         for processor in self:
-            function_args = inspect.signature(processor.__call__).parameters
-            if len(function_args) > 2:
-                if not all(arg in kwargs for arg in list(function_args.keys())[2:]):
+            extra_args = self._get_extra_args(processor)
+            if len(extra_args) > 0:
+                if not all(arg in kwargs for arg in extra_args):
                     raise ValueError(
-                        f"Make sure that all the required parameters: {list(function_args.keys())} for "
+                        f"Make sure that all the required parameters: {['input_ids', 'scores', *extra_args]} for "
                         f"{processor.__class__} are passed to the logits processor."
                     )
-                scores = processor(input_ids, scores, **kwargs)
+                processed_scores = processor(input_ids, scores, **kwargs)
+            elif self.fused and getattr(processor, "is_inplace", False):
+                if not owns_scores:
+                    scores = scores.clone()
+                    owns_scores = True
+                processed_scores = processor.process_inplace(input_ids, scores)
             else:
-                scores = processor(input_ids, scores)
+                processed_scores = processor(input_ids, scores)
+            owns_scores = owns_scores or processed_scores is not scores
+            scores = processed_scores
 
         return scores
 
@@ -129,6 +173,8 @@ class MinLengthLogitsProcessor(LogitsProcessor):
     ```
     """
 
+    is_inplace = True
+
     def __init__(self, min_length: int, eos_token_id: Union[int, List[int], torch.Tensor], device: str = "cpu"):
         if not isinstance(min_length, int) or min_length < 0:
             raise ValueError(f"`min_length` has to be a non-negative integer, but is {min_length}")
@@ -150,6 +196,12 @@ class MinLengthLogitsProcessor(LogitsProcessor):
             scores_processed = torch.where(eos_token_mask, -math.inf, scores)
         return scores_processed
 
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if input_ids.shape[-1] < self.min_length:
+            vocab_tensor = torch.arange(scores.shape[-1], device=scores.device)
+            scores.masked_fill_(isin_mps_friendly(vocab_tensor, self.eos_token_id), -math.inf)
+        return scores
+
 
 class MinNewTokensLengthLogitsProcessor(LogitsProcessor):
     r"""
@@ -188,6 +240,8 @@ class MinNewTokensLengthLogitsProcessor(LogitsProcessor):
     ```
     """
 
+    is_inplace = True
+
     def __init__(
         self,
         prompt_length_to_skip: int,
@@ -222,6 +276,12 @@ class MinNewTokensLengthLogitsProcessor(LogitsProcessor):
 
         return scores_processed
 
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if input_ids.shape[-1] - self.prompt_length_to_skip < self.min_new_tokens:
+            vocab_tensor = torch.arange(scores.shape[-1], device=scores.device)
+            scores.masked_fill_(isin_mps_friendly(vocab_tensor, self.eos_token_id), -math.inf)
+        return scores
+
 
 class TemperatureLogitsWarper(LogitsProcessor):
     r"""
@@ -271,6 +331,8 @@ class TemperatureLogitsWarper(LogitsProcessor):
     ```
     """
 
+    is_inplace = True
+
     def __init__(self, temperature: float):
         if not isinstance(temperature, float) or not (temperature > 0):
             except_msg = (
@@ -288,6 +350,9 @@ class TemperatureLogitsWarper(LogitsProcessor):
         scores_processed = scores / self.temperature
         return scores_processed
 
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return scores.div_(self.temperature)
+
 
 class RepetitionPenaltyLogitsProcessor(LogitsProcessor):
     r"""
@@ -903,6 +968,85 @@ def _calc_banned_ngram_tokens(
     return banned_tokens
 
 
+def _calc_banned_ngram_mask(ngram_size: int, prev_input_ids: torch.Tensor, vocab_size: int) -> torch.BoolTensor:
+    """
+    Tensor counterpart of [`_calc_banned_ngram_tokens`], computed on the device of `prev_input_ids`: every n-gram
+    window of every hypothesis is compared with its last (n-1)-gram, and the tokens following the matching ones are
+    banned.
+
+    Returns:
+        `torch.BoolTensor` of shape `(num_hypos, vocab_size)`, `True` for the banned tokens.
+    """
+    num_hypos, cur_len = prev_input_ids.shape
+    banned_tokens = torch.zeros((num_hypos, vocab_size + 1), dtype=torch.bool, device=prev_input_ids.device)
+    if cur_len < ngram_size:
+        return banned_tokens[:, :vocab_size]
+
+    # (num_hypos, cur_len - ngram_size + 1, ngram_size)
+    windows = prev_input_ids.unfold(-1, ngram_size, 1)
+    last_prefix = prev_input_ids[:, cur_len - ngram_size + 1 :].unsqueeze(1)
+    is_match = (windows[..., :-1] == last_prefix).all(dim=-1)
+    # the followers of the windows that don't match go to the extra column, which is dropped
+    banned_index = windows[..., -1].masked_fill(~is_match, vocab_size)
+    return banned_tokens.scatter_(-1, banned_index, True)[:, :vocab_size]
+
+
+class _RowParents:
+    """
+    Matches every row of `input_ids` to the row of the previous call it extends by one token, since beam search
+    reorders, duplicates and drops rows between steps without telling logits processors. The candidate parent of a
+    row is found by comparing polynomial hashes of the rows, computed on the device, and then confirmed by comparing
+    the tokens.
+    """
+
+    _hash_base = 1_000_003
+
+    def __init__(self):
+        self._prev_input_ids = None
+        self._prev_hashes = None
+        self._hash_powers = None
+
+    def _sequence_hashes(self, input_ids: torch.LongTensor) -> torch.LongTensor:
+        """
+        Returns a polynomial hash of every row of `input_ids`, wrapping around on overflow.
+        """
+        seq_len = input_ids.shape[-1]
+        if (
+            self._hash_powers is None
+            or self._hash_powers.shape[0] < seq_len
+            or self._hash_powers.device != input_ids.device
+        ):
+            powers = [1]
+            for _ in range(2 * seq_len):
+                powers.append(powers[-1] * self._hash_base % 2**64)
+            powers = [power - 2**64 if power >= 2**63 else power for power in powers]
+            self._hash_powers = torch.tensor(powers, dtype=torch.long, device=input_ids.device)
+        return (input_ids * self._hash_powers[:seq_len].flip(0)).sum(dim=-1)
+
+    def find(self, input_ids: torch.LongTensor) -> Optional[Tuple[torch.LongTensor, torch.BoolTensor]]:
+        """
+        Returns, for every row of `input_ids`, the index of the row of the previous call it extends and whether it
+        extends one at all, as tensors on the device of `input_ids`. Returns `None` if `input_ids` doesn't have as many
+        rows as on the previous call and one more token. `input_ids` then becomes the previous call.
+        """
+        prev_input_ids = self._prev_input_ids
+        self._prev_input_ids = input_ids
+        if (
+            prev_input_ids is None
+            or prev_input_ids.device != input_ids.device
+            or input_ids.shape != (prev_input_ids.shape[0], prev_input_ids.shape[1] + 1)
+        ):
+            self._prev_hashes = self._sequence_hashes(input_ids)
+            return None
+
+        prefix_hashes = self._sequence_hashes(input_ids[:, :-1])
+        # the hashes only point at a candidate, which must hold the very same tokens
+        parents = (prefix_hashes.unsqueeze(-1) == self._prev_hashes).int().argmax(dim=-1)
+        has_parent = (input_ids[:, :-1] == prev_input_ids[parents]).all(dim=-1)
+        self._prev_hashes = prefix_hashes * self._hash_base + input_ids[:, -1]
+        return parents, has_parent
+
+
 class NoRepeatNGramLogitsProcessor(LogitsProcessor):
     r"""
     N-grams are groups of "n" consecutive words, characters, or tokens taken from a sequence of text. Given the
@@ -924,6 +1068,10 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
     Args:
         ngram_size (`int`):
             All ngrams of size `ngram_size` can only occur once.
+        device_native (`bool`, *optional*):
+            Whether to find the banned tokens with tensor operations on the device of `input_ids`, which needs no
+            transfer to the host, instead of with n-gram tables kept on the host across steps. Defaults to doing so
+            when `input_ids` are not on the CPU.
 
     Examples:
 
@@ -945,21 +1093,97 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
     ```
     """
 
-    def __init__(self, ngram_size: int):
+    def __init__(self, ngram_size: int, device_native: Optional[bool] = None):
         if not isinstance(ngram_size, int) or ngram_size <= 0:
             raise ValueError(f"`ngram_size` has to be a strictly positive integer, but is {ngram_size}")
         self.ngram_size = ngram_size
+        self.device_native = device_native
+        # n-grams of every hypothesis as `{(n-1)-gram: following tokens}`, carried over to the hypotheses extending it
+        self._ngram_tables = None
+        self._row_parents = _RowParents()
+        # banned tokens of every hypothesis, with an extra column for padding, reused across steps
+        self._banned_tokens = None
+
+    def _update_ngram_tables(self, input_ids: torch.LongTensor) -> List[List[int]]:
+        """
+        Brings the n-gram tables up to date with `input_ids` and returns the last `ngram_size` tokens of every row.
+        When every row extends a row of the previous step by one token, the tables of the previous rows are reordered
+        and only the newest n-gram is added, otherwise they are built from scratch.
+
+        Logits processors aren't told how the beams were reordered, so finding the row each row extends still reads
+        whole rows: a hash of every prefix and an exact comparison with the previous rows, both done on the device in
+        O(sequence_length) per row. The host side is what gets cheaper. Each row gets one n-gram added and one
+        lookup, except that rows sharing a parent get a copy of its table, which is proportional to its size.
+        """
+        row_parents = self._row_parents.find(input_ids)
+        can_extend = row_parents is not None
+        if can_extend:
+            parents, has_parent = row_parents
+            host_rows = torch.cat(
+                [parents.unsqueeze(-1), has_parent.long().unsqueeze(-1), input_ids[:, -self.ngram_size :]], dim=-1
+            ).tolist()
+            can_extend = all(row[1] for row in host_rows)
+
+        if not can_extend:
+            self._ngram_tables = []
+            last_tokens = []
+            for tokens in input_ids.tolist():
+                table = {}
+                for ngram in zip(*[tokens[i:] for i in range(self.ngram_size)]):
+                    table[ngram[:-1]] = table.get(ngram[:-1], ()) + (ngram[-1],)
+                self._ngram_tables.append(table)
+                last_tokens.append(tokens[-self.ngram_size :])
+            return last_tokens
+
+        # the first row extending a previous row takes over its table, the others get a copy before anything is added
+        taken_parents = set()
+        ngram_tables = []
+        for parent, _, *_ in host_rows:
+            table = self._ngram_tables[parent]
+            ngram_tables.append(table if parent not in taken_parents else dict(table))
+            taken_parents.add(parent)
+        last_tokens = [row[2:] for row in host_rows]
+        for table, tokens in zip(ngram_tables, last_tokens):
+            if len(tokens) == self.ngram_size:
+                prefix = tuple(tokens[:-1])
+                table[prefix] = table.get(prefix, ()) + (tokens[-1],)
+        self._ngram_tables = ngram_tables
+        return last_tokens
 
     @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        num_batch_hypotheses = scores.shape[0]
-        cur_len = input_ids.shape[-1]
-        scores_processed = scores.clone()
-        banned_batch_tokens = _calc_banned_ngram_tokens(self.ngram_size, input_ids, num_batch_hypotheses, cur_len)
-        for i, banned_tokens in enumerate(banned_batch_tokens):
-            scores_processed[i, banned_tokens] = -float("inf")
+        device_native = self.device_native
+        if device_native is None:
+            device_native = input_ids.device.type != "cpu"
+        if device_native:
+            banned = _calc_banned_ngram_mask(self.ngram_size, input_ids, scores.shape[-1])
+            return scores.masked_fill(banned, -float("inf"))
+
+        last_tokens = self._update_ngram_tables(input_ids)
+        if input_ids.shape[-1] + 1 < self.ngram_size:
+            # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
+            return scores.clone()
+
+        prefix_len = self.ngram_size - 1
+        banned_batch_tokens = [
+            table.get(tuple(tokens[len(tokens) - prefix_len :]), ())
+            for table, tokens in zip(self._ngram_tables, last_tokens)
+        ]
+        max_banned = max(len(banned_tokens) for banned_tokens in banned_batch_tokens)
+        if max_banned == 0:
+            return scores.clone()
 
-        return scores_processed
+        vocab_size = scores.shape[-1]
+        banned_index = torch.tensor(
+            [list(banned) + [vocab_size] * (max_banned - len(banned)) for banned in banned_batch_tokens],
+            device=scores.device,
+        )
+        if self._banned_tokens is None or self._banned_tokens.shape != (scores.shape[0], vocab_size + 1):
+            self._banned_tokens = torch.empty(
+                (scores.shape[0], vocab_size + 1), dtype=torch.bool, device=scores.device
+            )
+        banned = self._banned_tokens.fill_(False).scatter_(-1, banned_index, True)
+        return scores.masked_fill(banned[:, :vocab_size], -float("inf"))
 
 
 class EncoderNoRepeatNGramLogitsProcessor(LogitsProcessor):
@@ -1031,6 +1255,116 @@ class EncoderNoRepeatNGramLogitsProcessor(LogitsProcessor):
         return scores_processed
 
 
+class _SequenceBiasAutomaton:
+    """
+    Aho-Corasick automaton over the prefixes (all the tokens but the last) of the biased sequences of more than one
+    token, compiled into tensors. The state of a hypothesis is the longest suffix of its tokens that is one of these
+    prefixes, and every state holds the biases of all the sequences whose prefix ends there, so that finding and
+    applying them doesn't depend on how many sequences are biased.
+
+    Args:
+        sequence_bias (`Dict[Tuple[int], float]`):
+            The biased sequences and their biases.
+        vocab_size (`int`):
+            The size of the vocabulary.
+        device (`torch.device`):
+            The device to build the tensors on.
+    """
+
+    def __init__(self, sequence_bias: Dict[Tuple[int], float], vocab_size: int, device: torch.device):
+        self.vocab_size = vocab_size
+
+        # trie of the prefixes, the root standing for the empty one
+        children = [{}]
+        depths = [0]
+        # `(last token, bias)` of the sequences whose prefix is exactly each node
+        own_biases = [[]]
+        for sequence_ids, bias in sequence_bias.items():
+            if len(sequence_ids) == 1:
+                continue
+            node = 0
+            for token_id in sequence_ids[:-1]:
+                if token_id not in children[node]:
+                    children[node][token_id] = len(children)
+                    children.append({})
+                    depths.append(depths[node] + 1)
+                    own_biases.append([])
+                node = children[node][token_id]
+            own_biases[node].append((sequence_ids[-1], bias))
+        self.num_states = len(children)
+        self.max_depth = max(depths)
+
+        # failure links, transitions and biases in breadth-first order, so that the state a node fails to is done first.
+        # Transitions to the children of the root are the same from every state, so each state only keeps the others.
+        failures = [0] * self.num_states
+        transitions = [{} for _ in range(self.num_states)]
+        # `(last token, bias, is own)` of the sequences whose prefix is a suffix of each node
+        biases = [[] for _ in range(self.num_states)]
+        queue = list(children[0].values())
+        for node in queue:
+            failure = failures[node]
+            transitions[node] = {**transitions[failure], **children[node]}
+            biases[node] = [(token_id, bias, True) for token_id, bias in own_biases[node]] + [
+                (token_id, bias, False) for token_id, bias, _ in biases[failure]
+            ]
+            for token_id, child in children[node].items():
+                failures[child] = transitions[failure].get(token_id, children[0].get(token_id, 0))
+                queue.append(child)
+
+        keys = sorted(
+            (node * vocab_size + token_id, next_node)
+            for node in range(1, self.num_states)
+            for token_id, next_node in transitions[node].items()
+        )
+        self.transition_keys = torch.tensor([key for key, _ in keys], dtype=torch.long, device=device)
+        self.transition_states = torch.tensor([state for _, state in keys], dtype=torch.long, device=device)
+        self.root_transitions = torch.zeros(vocab_size, dtype=torch.long, device=device)
+        for token_id, child in children[0].items():
+            self.root_transitions[token_id] = child
+        self.depths = torch.tensor(depths, dtype=torch.long, device=device)
+
+        # biases of every state, padded with zeros
+        max_biases = max(len(state_biases) for state_biases in biases)
+        padding = [(0, 0.0, False)]
+        biases = [state_biases + padding * (max_biases - len(state_biases)) for state_biases in biases]
+        self.bias_token_ids = torch.tensor(
+            [[token_id for token_id, _, _ in state_biases] for state_biases in biases], dtype=torch.long, device=device
+        ).view(self.num_states, max_biases)
+        self.bias_values = torch.tensor(
+            [[bias for _, bias, _ in state_biases] for state_biases in biases], dtype=torch.float, device=device
+        ).view(self.num_states, max_biases)
+        self.bias_is_own = torch.tensor(
+            [[is_own for _, _, is_own in state_biases] for state_biases in biases], dtype=torch.bool, device=device
+        ).view(self.num_states, max_biases)
+
+    def get_states(self, input_ids: torch.LongTensor) -> torch.LongTensor:
+        """
+        Returns the state of every row of `input_ids`. A state is never deeper than the longest prefix, so only that
+        many last tokens need to be read.
+        """
+        states = torch.zeros(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
+        for token_ids in input_ids[:, -self.max_depth :].unbind(dim=-1):
+            next_states = self.root_transitions[token_ids]
+            if self.transition_keys.numel() > 0:
+                query = states * self.vocab_size + token_ids
+                index = torch.searchsorted(self.transition_keys, query).clamp(max=self.transition_keys.numel() - 1)
+                next_states = torch.where(
+                    self.transition_keys[index] == query, self.transition_states[index], next_states
+                )
+            states = next_states
+        return states
+
+    def add_bias(self, input_ids: torch.LongTensor, bias: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Adds, in place, the biases of the sequences that the next token can complete to `bias`.
+        """
+        states = self.get_states(input_ids)
+        # a sequence whose prefix is the whole context is left out
+        is_whole_context = self.bias_is_own[states] & (self.depths[states] == input_ids.shape[-1]).unsqueeze(-1)
+        values = self.bias_values[states].masked_fill(is_whole_context, 0.0).to(bias.dtype)
+        return bias.scatter_add_(-1, self.bias_token_ids[states], values)
+
+
 class SequenceBiasLogitsProcessor(LogitsProcessor):
     """
     [`LogitsProcessor`] that applies an additive bias on sequences. The bias is applied to the last token of a sequence
@@ -1104,6 +1438,7 @@ class SequenceBiasLogitsProcessor(LogitsProcessor):
         # Bias variables that will be populated on the first call (for retrocompatibility purposes, the vocabulary size
         # is infered in the first usage, which inhibits initializing here)
         self.length_1_bias = None
+        self.automaton = None
         self.prepared_bias_variables = False
 
     @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
@@ -1118,23 +1453,10 @@ class SequenceBiasLogitsProcessor(LogitsProcessor):
         # 3 - include the bias from length = 1
         bias += self.length_1_bias
 
-        # 4 - include the bias from length > 1, after determining which biased sequences may be completed.
-        for sequence_ids, sequence_bias in self.sequence_bias.items():
-            if len(sequence_ids) == 1:  # the sequence is of length 1, already applied
-                continue
-            if len(sequence_ids) > input_ids.shape[1]:  # the sequence is longer than the context, ignore
-                continue
-            prefix_length = len(sequence_ids) - 1
-            last_token = sequence_ids[-1]
-            matching_rows = torch.eq(
-                input_ids[:, -prefix_length:],
-                torch.tensor(sequence_ids[:-1], dtype=input_ids.dtype, device=input_ids.device),
-            ).prod(dim=1)
-            bias[:, last_token] += torch.where(
-                matching_rows.bool(),
-                torch.tensor(sequence_bias, device=input_ids.device),
-                torch.tensor(0.0, device=input_ids.device),
-            )
+        # 4 - include the bias from length > 1, read from the state of every hypothesis in the automaton of the biased
+        # sequences, which tells which of them may be completed.
+        if self.automaton is not None:
+            self.automaton.add_bias(input_ids, bias)
 
         # 5 - apply the bias to the scores
         scores_processed = scores + bias
@@ -1162,6 +1484,10 @@ class SequenceBiasLogitsProcessor(LogitsProcessor):
             if len(sequence_ids) == 1:
                 self.length_1_bias[sequence_ids[-1]] = bias
 
+        # Sequences of length > 1 are compiled into an automaton once, instead of being matched one by one every step.
+        if any(len(sequence_ids) > 1 for sequence_ids in self.sequence_bias):
+            self.automaton = _SequenceBiasAutomaton(self.sequence_bias, vocabulary_size, scores.device)
+
         self.prepared_bias_variables = True
 
     def _validate_arguments(self):
@@ -1310,6 +1636,15 @@ class PrefixConstrainedLogitsProcessor(LogitsProcessor):
             arguments `inputs_ids` and the batch ID `batch_id`. It has to return a list with the allowed tokens for the
             next generation step conditioned on the previously generated tokens `inputs_ids` and the batch ID
             `batch_id`.
+        num_beams (`int`):
+            The number of beams of every batch item.
+        batched (`bool`, *optional*):
+            Whether `prefix_allowed_tokens_fn` handles all the hypotheses at once. It is then called with the batch IDs
+            of the hypotheses, of shape `(batch_size * num_beams,)`, and their `input_ids`, and has to return either a
+            boolean tensor of shape `(batch_size * num_beams, vocab_size)` that is `True` for the allowed tokens, or
+            the allowed tokens of every hypothesis as an integer tensor padded with negative values. Defaults to the
+            `batched` attribute of `prefix_allowed_tokens_fn` if it has one, so that it can also be set through
+            [`~generation.GenerationMixin.generate`].
 
     Examples:
 
@@ -1346,29 +1681,71 @@ class PrefixConstrainedLogitsProcessor(LogitsProcessor):
     ```
     """
 
-    def __init__(self, prefix_allowed_tokens_fn: Callable[[int, torch.Tensor], List[int]], num_beams: int):
+    def __init__(
+        self,
+        prefix_allowed_tokens_fn: Callable[[int, torch.Tensor], List[int]],
+        num_beams: int,
+        batched: Optional[bool] = None,
+    ):
         self._prefix_allowed_tokens_fn = prefix_allowed_tokens_fn
         self._num_beams = num_beams
+        if batched is None:
+            batched = getattr(prefix_allowed_tokens_fn, "batched", False)
+        self._batched = batched
+        # banned tokens of every hypothesis, with an extra column for padding, reused across steps
+        self._banned_tokens = None
+
+    def _get_banned_tokens(self, num_hypos: int, vocab_size: int, device: torch.device) -> torch.BoolTensor:
+        if self._banned_tokens is None or self._banned_tokens.shape != (num_hypos, vocab_size + 1):
+            self._banned_tokens = torch.empty((num_hypos, vocab_size + 1), dtype=torch.bool, device=device)
+        return self._banned_tokens
+
+    def _unsatisfiable_error(self, batch_id: int) -> ValueError:
+        return ValueError(
+            f"`prefix_allowed_tokens_fn` returned an empty list for batch ID {batch_id}."
+            f"This means that the constraint is unsatisfiable. Please check your implementation"
+            f"of `prefix_allowed_tokens_fn` "
+        )
+
+    def _batched_banned_tokens(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.BoolTensor:
+        num_hypos, vocab_size = scores.shape
+        batch_ids = torch.arange(num_hypos, device=input_ids.device) // self._num_beams
+        allowed = self._prefix_allowed_tokens_fn(batch_ids, input_ids).to(scores.device)
+        banned_tokens = self._get_banned_tokens(num_hypos, vocab_size, scores.device)
+
+        if allowed.dtype == torch.bool:
+            is_satisfiable = allowed.any(dim=-1)
+            banned = torch.logical_not(allowed, out=banned_tokens[:, :vocab_size])
+        else:
+            is_satisfiable = (allowed >= 0).any(dim=-1)
+            allowed = allowed.masked_fill(allowed < 0, vocab_size)
+            banned = banned_tokens.fill_(True).scatter_(-1, allowed, False)[:, :vocab_size]
+
+        if not is_satisfiable.all():
+            raise self._unsatisfiable_error(is_satisfiable.int().argmin().item() // self._num_beams)
+        return banned
 
     @add_start_docstrings(LOGITS_PROCESSOR_INPUTS_DOCSTRING)
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        mask = torch.full_like(scores, -math.inf)
-        batch_size = input_ids.shape[0] // self._num_beams
+        if self._batched:
+            return scores.masked_fill(self._batched_banned_tokens(input_ids, scores), -math.inf)
 
+        num_hypos, vocab_size = scores.shape
+        batch_size = num_hypos // self._num_beams
+        allowed_tokens = []
         for batch_id in range(batch_size):
             for beam_id in range(self._num_beams):
                 sent = input_ids[batch_id * self._num_beams + beam_id]
                 prefix_allowed_tokens = self._prefix_allowed_tokens_fn(batch_id, sent)
                 if len(prefix_allowed_tokens) == 0:
-                    raise ValueError(
-                        f"`prefix_allowed_tokens_fn` returned an empty list for batch ID {batch_id}."
-                        f"This means that the constraint is unsatisfiable. Please check your implementation"
-                        f"of `prefix_allowed_tokens_fn` "
-                    )
-                mask[batch_id * self._num_beams + beam_id, prefix_allowed_tokens] = 0
+                    raise self._unsatisfiable_error(batch_id)
+                allowed_tokens.append(torch.as_tensor(prefix_allowed_tokens, dtype=torch.long))
 
-        scores_processed = scores + mask
-        return scores_processed
+        # the allowed tokens of all the hypotheses are written at once, padding going to the extra column
+        allowed_index = torch.nn.utils.rnn.pad_sequence(allowed_tokens, batch_first=True, padding_value=vocab_size)
+        banned_tokens = self._get_banned_tokens(num_hypos, vocab_size, scores.device)
+        banned = banned_tokens.fill_(True).scatter_(-1, allowed_index.to(scores.device), False)
+        return scores.masked_fill(banned[:, :vocab_size], -math.inf)
 
 
 class HammingDiversityLogitsProcessor(LogitsProcessor):
@@ -1539,6 +1916,8 @@ class ForcedBOSTokenLogitsProcessor(LogitsProcessor):
     ```
     """
 
+    is_inplace = True
+
     def __init__(self, bos_token_id: int):
         self.bos_token_id = bos_token_id
 
@@ -1551,6 +1930,12 @@ class ForcedBOSTokenLogitsProcessor(LogitsProcessor):
             scores_processed[:, self.bos_token_id] = 0
         return scores_processed
 
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if input_ids.shape[-1] == 1:
+            scores.fill_(-math.inf)
+            scores[:, self.bos_token_id] = 0
+        return scores
+
 
 class ForcedEOSTokenLogitsProcessor(LogitsProcessor):
     r"""
@@ -1586,6 +1971,8 @@ class ForcedEOSTokenLogitsProcessor(LogitsProcessor):
     ```
     """
 
+    is_inplace = True
+
     def __init__(self, max_length: int, eos_token_id: Union[int, List[int], torch.Tensor], device: str = "cpu"):
         self.max_length = max_length
 
@@ -1607,6 +1994,12 @@ class ForcedEOSTokenLogitsProcessor(LogitsProcessor):
             scores_processed[:, self.eos_token_id] = 0
         return scores_processed
 
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if input_ids.shape[-1] == self.max_length - 1:
+            scores.fill_(-math.inf)
+            scores[:, self.eos_token_id] = 0
+        return scores
+
 
 class InfNanRemoveLogitsProcessor(LogitsProcessor):
     r"""
@@ -1802,6 +2195,8 @@ class SuppressTokensAtBeginLogitsProcessor(LogitsProcessor):
     ```
     """
 
+    is_inplace = True
+
     def __init__(self, begin_suppress_tokens, begin_index, device: str = "cpu"):
         self.begin_suppress_tokens = torch.tensor(list(begin_suppress_tokens), device=device)
         self.begin_index = begin_index
@@ -1819,6 +2214,12 @@ class SuppressTokensAtBeginLogitsProcessor(LogitsProcessor):
 
         return scores_processed
 
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if input_ids.shape[-1] == self.begin_index:
+            vocab_tensor = torch.arange(scores.shape[-1], device=scores.device)
+            scores.masked_fill_(isin_mps_friendly(vocab_tensor, self.begin_suppress_tokens), -float("inf"))
+        return scores
+
 
 class SuppressTokensLogitsProcessor(LogitsProcessor):
     r"""
@@ -1849,6 +2250,8 @@ class SuppressTokensLogitsProcessor(LogitsProcessor):
     ```
     """
 
+    is_inplace = True
+
     def __init__(self, suppress_tokens, device: str = "cpu"):
         self.suppress_tokens = torch.tensor(list(suppress_tokens), device=device)
 
@@ -1859,6 +2262,10 @@ class SuppressTokensLogitsProcessor(LogitsProcessor):
         scores = torch.where(suppress_token_mask, -float("inf"), scores)
         return scores
 
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        vocab_tensor = torch.arange(scores.shape[-1], device=scores.device)
+        return scores.masked_fill_(isin_mps_friendly(vocab_tensor, self.suppress_tokens), -float("inf"))
+
 
 class WhisperTimeStampLogitsProcessor(LogitsProcessor):
     r"""
@@ -2944,13 +3351,106 @@ class SynthIDTextWatermarkLogitsProcessor(LogitsProcessor):
         return coinflip_prob + coinflip_prob * (1 - coinflip_prob) * (1 - (1 / vocab_size))
 
 
+def _expected_token_masks(
+    expected_token_ids: List[Optional[int]], vocab_size: int, device: torch.device
+) -> torch.BoolTensor:
+    """
+    Row `i` of the returned `(len(expected_token_ids), vocab_size)` mask bans every token but `expected_token_ids[i]`,
+    or nothing when it is `None`.
+    """
+    masks = torch.ones((len(expected_token_ids), vocab_size), dtype=torch.bool, device=device)
+    for position, token_id in enumerate(expected_token_ids):
+        if token_id is None:
+            masks[position] = False
+        else:
+            masks[position, token_id] = False
+    return masks
+
+
 class TemplateConstraintLogitsProcessor(LogitsProcessor):
-    def __init__(self, template, vocab_size):
+    r"""
+    [`LogitsProcessor`] that only lets the tokens of `template` be generated, `None` standing for any token.
+
+    Args:
+        template (`List[Optional[int]]`):
+            The tokens to generate, one per step.
+        vocab_size (`int`):
+            The size of the vocabulary.
+        scorer ([`ConstrainedBeamSearchScorer`], *optional*):
+            The scorer of a constrained beam search enforcing a [`TemplateConstraint`] built from `template`. When it
+            is given (or attached later as `scorer`), the tokens allowed for every beam are read from the live
+            constraint state of that beam in the scorer, instead of a `position` counter shared by all the beams, so
+            that beams that are at different points of the template, or restarted it, are each handled correctly. A
+            scorer with a different number of beams than `input_ids` has rows is ignored.
+        boost (`float`, *optional*):
+            With a `scorer`, how much to add to the scores of the allowed tokens instead of banning all the others.
+        constraint ([`TemplateConstraint`], *optional*):
+            The constraint built from `template` that is enforced by the constrained beam search. Every
+            [`ConstrainedBeamSearchScorer`] built with it from then on is attached as `scorer` until its `finalize`,
+            which includes the one that [`~generation.GenerationMixin.generate`] builds when `constraint` is passed in
+            `constraints`. Only the very same object is recognized: a constraint copied on the way (e.g. inside a
+            `GenerationConfig`, which `generate` deep-copies) is not.
+
+    Examples:
+
+    ```python
+    >>> constraint = TemplateConstraint([None, 7, None, 9])
+    >>> processor = TemplateConstraintLogitsProcessor(constraint.template, model.config.vocab_size, constraint=constraint)
+    >>> outputs = model.generate(
+    ...     inputs["input_ids"], num_beams=4, constraints=[constraint], logits_processor=LogitsProcessorList([processor])
+    ... )
+    ```
+    """
+
+    is_inplace = True
+
+    def __init__(self, template, vocab_size, scorer=None, boost: Optional[float] = None, constraint=None):
         self.template = template
         self.vocab_size = vocab_size
+        self.scorer = scorer
+        self.boost = boost
+        self.constraint = constraint
+        if constraint is not None:
+            ConstrainedBeamSearchScorer.attach_on_init(self)
         self.position = 0
+        # banned tokens of every position of the template, built once on the device of the scores
+        self._banned_masks = None
+        # banned tokens of every beam, reused across steps
+        self._banned_tokens = None
+
+    def _beam_constraint_scores(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, inplace: bool
+    ) -> torch.FloatTensor:
+        advance_tokens, advance_any, completed = self.scorer.get_beam_advance_tokens(input_ids)
+        is_padding = advance_tokens < 0
+        # beams that fulfilled the template or can take any token are left alone
+        is_free = completed | advance_any | is_padding.all(dim=-1)
+
+        if self.boost is not None:
+            boost = (~is_padding & ~is_free.unsqueeze(-1)).to(scores.dtype) * self.boost
+            scatter_add = scores.scatter_add_ if inplace else scores.scatter_add
+            return scatter_add(-1, advance_tokens.clamp(min=0), boost)
+
+        if self._banned_tokens is None or self._banned_tokens.shape != scores.shape:
+            self._banned_tokens = torch.empty(scores.shape, dtype=torch.bool, device=scores.device)
+        # padding repeats the first allowed token of its beam, which is allowed anyway
+        allowed_tokens = torch.where(is_padding, advance_tokens[:, :1], advance_tokens).clamp(min=0)
+        banned = self._banned_tokens.fill_(True).scatter_(-1, allowed_tokens, False)
+        banned &= ~is_free.unsqueeze(-1)
+        masked_fill = scores.masked_fill_ if inplace else scores.masked_fill
+        return masked_fill(banned, -float("inf"))
 
     def __call__(self, input_ids, scores):
+        return self._process(input_ids, scores, inplace=False)
+
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self._process(input_ids, scores, inplace=True)
+
+    def _process(self, input_ids, scores, inplace: bool):
+        # a scorer left over from another search (e.g. with another batch size or `num_beams`) doesn't track these rows
+        if self.scorer is not None and self.scorer.num_beams * len(self.scorer._beam_hyps) == input_ids.shape[0]:
+            return self._beam_constraint_scores(input_ids, scores, inplace)
+
         if self.position >= len(self.template):
             return scores 
 
@@ -2960,44 +3460,90 @@ class TemplateConstraintLogitsProcessor(LogitsProcessor):
         if expected is None:
             return scores
         else:
-            mask = torch.full_like(scores, -float('inf'))
-            mask[..., expected] = 0 
-            return scores + mask
+            if (
+                self._banned_masks is None
+                or self._banned_masks.shape[-1] != scores.shape[-1]
+                or self._banned_masks.device != scores.device
+            ):
+                self._banned_masks = _expected_token_masks(self.template, scores.shape[-1], scores.device)
+            masked_fill = scores.masked_fill_ if inplace else scores.masked_fill
+            return masked_fill(self._banned_masks[self.position - 1], -float("inf"))
+
 
 class SimpleOrderedConstraintLogitsProcessor(LogitsProcessor):
+    is_inplace = True
+
     def __init__(self, ordered_token_ids, vocab_size):
         self.ordered_token_ids = ordered_token_ids
         self.vocab_size = vocab_size
+        # banned tokens of every position, built once on the device of the scores
+        self._banned_masks = None
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self._process(input_ids, scores, inplace=False)
+
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self._process(input_ids, scores, inplace=True)
+
+    def _process(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, inplace: bool) -> torch.FloatTensor:
         position = input_ids.shape[1]  # current position in generation
 
         if position >= len(self.ordered_token_ids):
             return scores  # all constraints satisfied
 
-        expected_token = self.ordered_token_ids[position]
+        if (
+            self._banned_masks is None
+            or self._banned_masks.shape[-1] != scores.shape[-1]
+            or self._banned_masks.device != scores.device
+        ):
+            self._banned_masks = _expected_token_masks(self.ordered_token_ids, scores.shape[-1], scores.device)
 
         # Mask all tokens except the expected one
-        mask = torch.full_like(scores, -float("inf"))
-        mask[:, expected_token] = 0.0
-        return scores + mask
+        masked_fill = scores.masked_fill_ if inplace else scores.masked_fill
+        return masked_fill(self._banned_masks[position], -float("inf"))
+
 
 class OrderedConstraintLogitsProcessor(LogitsProcessor):
+    is_inplace = True
+
     def __init__(self, ordered_token_ids: List[int]):
         self.ordered_token_ids = ordered_token_ids
-        self.position = 0
+        self._expected_token_ids = torch.tensor(ordered_token_ids, dtype=torch.long)
+        # the position of every row of `input_ids` in `ordered_token_ids`, as of the previous call
+        self.positions = None
+        self._row_parents = _RowParents()
+
+    def _parent_positions(self, input_ids: torch.LongTensor) -> torch.LongTensor:
+        # beam search may have reordered the rows since the previous call, so every row picks up the position of the
+        # row it extends, and starts over if there is none
+        row_parents = self._row_parents.find(input_ids)
+        if row_parents is None:
+            return torch.zeros(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
+        parents, has_parent = row_parents
+        return torch.where(has_parent, self.positions[parents], 0)
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        if self.position >= len(self.ordered_token_ids):
-            return scores  # no more constraints
+        return self._process(input_ids, scores, inplace=False)
 
-        expected_token = self.ordered_token_ids[self.position]
+    def process_inplace(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        return self._process(input_ids, scores, inplace=True)
+
+    def _process(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, inplace: bool) -> torch.FloatTensor:
+        num_tokens = self._expected_token_ids.shape[0]
+        if num_tokens == 0:
+            return scores  # no constraints
+        if self._expected_token_ids.device != input_ids.device:
+            self._expected_token_ids = self._expected_token_ids.to(input_ids.device)
+
+        positions = self._parent_positions(input_ids)
+        is_pending = positions < num_tokens
+        expected_tokens = self._expected_token_ids[positions.clamp(max=num_tokens - 1)]
 
         # If the last token matches expected_token, we move to the next
-        if input_ids[0, -1].item() == expected_token:
-            self.position += 1
-            return scores
+        matches = is_pending & (input_ids[:, -1] == expected_tokens)
+        self.positions = positions + matches.long()
 
         # Else: encourage the expected token
-        scores[..., expected_token] += 5.0  # boost, not mask, empirical value..
-        return scores
+        boost = (is_pending & ~matches).to(scores.dtype) * 5.0  # boost, not mask, empirical value..
+        scatter_add = scores.scatter_add_ if inplace else scores.scatter_add
+        return scatter_add(-1, expected_tokens.unsqueeze(-1), boost.unsqueeze(-1))
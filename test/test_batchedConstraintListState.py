@@ -0,0 +1,70 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import random
+import unittest
+import torch
+from transformers.generation.beam_constraints import (
+    BatchedConstraintListState,
+    ConstraintListState,
+    DisjunctiveConstraint,
+    OrderedConstraint,
+    PhrasalConstraint,
+    TemplateConstraint,
+)
+
+
+class TestBatchedConstraintListState(unittest.TestCase):
+    def assert_matches_list_state(self, constraints, vocab_size=12, num_seqs=50, seq_len=15):
+        batched = BatchedConstraintListState(constraints)
+        rng = random.Random(0)
+        sequences = torch.tensor([[rng.randrange(vocab_size) for _ in range(seq_len)] for _ in range(num_seqs)])
+
+        states = batched.initial_states(sequences[:, :0])
+        for step in range(seq_len):
+            states = batched.step(states, sequences[:, step])
+            completed = batched.get_completed(states)
+            banks = batched.get_banks(states)
+            advances = batched.get_advances(states)
+            remaining_steps = batched.get_remaining_steps(states)
+            for seq_idx in range(num_seqs):
+                state = ConstraintListState([constraint.copy() for constraint in constraints])
+                state.reset(sequences[seq_idx, : step + 1].tolist())
+                self.assertEqual(completed[seq_idx].item(), state.completed)
+                self.assertEqual(banks[seq_idx].item(), state.get_bank())
+                self.assertEqual(advances[seq_idx], (state.completed, state.advance()))
+                self.assertEqual(remaining_steps[seq_idx].item(), state.remaining_steps())
+
+        self.assertTrue(torch.equal(batched.initial_states(sequences), states))
+
+    def test_template(self):
+        self.assert_matches_list_state([TemplateConstraint([5, None, 3])])
+
+    def test_ordered(self):
+        self.assert_matches_list_state([OrderedConstraint([5, None, 3, 7])])
+
+    def test_multiple_constraints(self):
+        self.assert_matches_list_state(
+            [PhrasalConstraint([1, 2]), DisjunctiveConstraint([[3], [4, 5]]), TemplateConstraint([None, 6])]
+        )
+
+    def test_pending_order(self):
+        # a constraint whose progress is broken goes back to the end of the queue, behind the other one starting with 1
+        self.assert_matches_list_state([PhrasalConstraint([1, 2, 3]), PhrasalConstraint([1, 4])], vocab_size=5)
+
+    def test_state_layout(self):
+        batched = BatchedConstraintListState([PhrasalConstraint([1, 2]), TemplateConstraint([5, None, 3])])
+        states = batched.initial_states(torch.tensor([[1], [5]]))
+        self.assertEqual(states.dtype, torch.int32)
+        self.assertEqual(states.shape, (2, 3, 2))
+        self.assertEqual(
+            states[:, batched.STATUS].tolist(),
+            [[batched.IN_PROGRESS, batched.PENDING], [batched.PENDING, batched.IN_PROGRESS]],
+        )
+
+        # beams are reordered with plain indexing, with any number of leading dimensions
+        self.assertTrue(torch.equal(batched.get_banks(states[[1, 0]]), batched.get_banks(states).flip(0)))
+        self.assertEqual(batched.get_banks(states.unsqueeze(0)).shape, (1, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import unittest
+import torch
+from transformers.generation.beam_constraints import (
+    ConstraintListState,
+    DisjunctiveConstraint,
+    PhrasalConstraint,
+    TemplateConstraint,
+)
+from transformers.generation.beam_search import ConstrainedBeamSearchScorer
+from transformers.generation.logits_process import LogitsProcessorList, NoRepeatNGramLogitsProcessor
+
+
+def make_scorer(constraints, batch_size=1, num_beams=2, **kwargs):
+    return ConstrainedBeamSearchScorer(
+        batch_size=batch_size, num_beams=num_beams, constraints=constraints, device="cpu", **kwargs
+    )
+
+
+def process(scorer, input_ids, vocab_scores, next_tokens=None, next_indices=None, eos_token_id=None):
+    """
+    Runs `scorer.process` on the log-probabilities `vocab_scores` of `input_ids`. The candidates are picked like
+    `generate` does unless `next_tokens` (and `next_indices`, defaulting to the first beam) are given per batch item.
+    """
+    batch_size, vocab_size = len(scorer._beam_hyps), vocab_scores.shape[-1]
+    if next_tokens is None:
+        flat_scores = vocab_scores.view(batch_size, scorer.num_beams * vocab_size)
+        next_scores, flat_tokens = flat_scores.topk(2 * scorer.num_beams, dim=1)
+        next_indices, next_tokens = flat_tokens // vocab_size, flat_tokens % vocab_size
+    else:
+        next_tokens = torch.tensor(next_tokens)
+        next_indices = torch.zeros_like(next_tokens) if next_indices is None else torch.tensor(next_indices)
+        beam_offsets = torch.arange(batch_size)[:, None] * scorer.num_beams
+        next_scores = vocab_scores[beam_offsets + next_indices, next_tokens]
+    return scorer.process(
+        input_ids, next_scores, next_tokens, next_indices, vocab_scores, pad_token_id=0, eos_token_id=eos_token_id
+    )
+
+
+def beam_search(scorer, input_ids, max_length, logits_processor=None, vocab_size=16, eos_token_id=None):
+    """
+    Runs constrained beam search like `generate` does, with fixed random logits standing in for the model and, by
+    default, `no_repeat_ngram_size=2` banning tokens to -inf. Returns the output of `scorer.finalize`.
+    """
+    if logits_processor is None:
+        logits_processor = LogitsProcessorList([NoRepeatNGramLogitsProcessor(2)])
+    generator = torch.Generator().manual_seed(0)
+    beam_scores = torch.zeros(input_ids.shape[0])
+    while input_ids.shape[-1] < max_length:
+        logits = torch.randn(input_ids.shape[0], vocab_size, generator=generator)
+        vocab_scores = logits_processor(input_ids, torch.log_softmax(logits, dim=-1)) + beam_scores[:, None]
+        outputs = process(scorer, input_ids, vocab_scores, eos_token_id=eos_token_id)
+        beam_scores = outputs["next_beam_scores"]
+        input_ids = torch.cat([input_ids[outputs["next_beam_indices"]], outputs["next_beam_tokens"][:, None]], -1)
+        if scorer.is_done:
+            break
+    return scorer.finalize(input_ids, beam_scores, None, None, max_length, pad_token_id=0, eos_token_id=eos_token_id)
+
+
+class TestAdvanceBudget(unittest.TestCase):
+    def make_scorer(self, advance_budget, compile_constraints=True):
+        return make_scorer(
+            [DisjunctiveConstraint([[3], [4], [5], [6]])],
+            max_length=10,
+            compile_constraints=compile_constraints,
+            advance_budget=advance_budget,
+        )
+
+    def test_keeps_most_likely_tokens_in_order(self):
+        scorer = self.make_scorer(advance_budget=2)
+        vocab_scores = torch.zeros(2, 8)
+        vocab_scores[0, [3, 4, 5, 6]] = torch.tensor([0.4, 0.1, 0.3, 0.2])
+        vocab_scores[1, [3, 4, 5, 6]] = torch.tensor([0.1, 0.4, 0.2, 0.3])
+        kept = scorer.select_advance_tokens({0: [3, 4, 5, 6], 1: [6, 5, 4, 3]}, vocab_scores)
+        self.assertEqual(kept, {0: [3, 5], 1: [6, 4]})
+
+    def test_banned_tokens_rank_above_padding(self):
+        scorer = self.make_scorer(advance_budget=2)
+        vocab_scores = torch.zeros(2, 8)
+        # the second beam proposes fewer tokens, and all but one of them are banned
+        vocab_scores[1, [4, 5]] = -float("inf")
+        kept = scorer.select_advance_tokens({0: [3, 4, 5, 6], 1: [4, 5, 6]}, vocab_scores)
+        self.assertEqual(len(kept[1]), 2)
+        self.assertIn(6, kept[1])
+        self.assertTrue(set(kept[1]) <= {4, 5, 6})
+
+    def test_beams_within_budget_untouched(self):
+        scorer = self.make_scorer(advance_budget=2)
+        advance_tokens = {0: [3, 4], 1: [5]}
+        self.assertEqual(scorer.select_advance_tokens(advance_tokens, torch.zeros(2, 8)), advance_tokens)
+
+    def test_invalid_budget(self):
+        with self.assertRaises(ValueError):
+            self.make_scorer(advance_budget=0)
+
+    def test_process(self):
+        for compile_constraints in (True, False):
+            scorer = self.make_scorer(advance_budget=1, compile_constraints=compile_constraints)
+            vocab_scores = torch.log_softmax(torch.arange(8, dtype=torch.float).repeat(2, 1), dim=-1)
+            outputs = process(scorer, torch.tensor([[0], [0]]), vocab_scores, next_tokens=[[7, 2, 1, 0]])
+            # only the most likely token completing the constraint is proposed, and it is ranked first
+            self.assertEqual(outputs["next_beam_tokens"].tolist(), [6, 7])
+
+    def test_beam_search_with_banned_tokens(self):
+        # after the prompt of the first batch item, no_repeat_ngram_size=2 bans 4 and 5, 2 of the 3 tokens that advance
+        # its beams, while those of the second batch item propose 4 tokens
+        input_ids = torch.tensor([[3, 4, 2, 3, 5, 2, 3]] * 2 + [[2] * 7] * 2)
+        for compile_constraints in (True, False):
+            scorer = make_scorer(
+                [DisjunctiveConstraint([[3, 4, 10], [3, 5, 10], [3, 6, 10], [7], [8], [9]])],
+                batch_size=2,
+                max_length=12,
+                compile_constraints=compile_constraints,
+                advance_budget=2,
+            )
+            sequences = beam_search(scorer, input_ids, 12)["sequences"]
+            for sequence in sequences:
+                self.assertTrue(scorer.check_completes_constraints(sequence.tolist()))
+
+
+
+class TestPruneInfeasibleBeams(unittest.TestCase):
+    def make_scorer(self, constraints, max_length, compile_constraints=True, prune_infeasible_beams=True):
+        return make_scorer(
+            constraints,
+            batch_size=2,
+            max_length=max_length,
+            compile_constraints=compile_constraints,
+            prune_infeasible_beams=prune_infeasible_beams,
+        )
+
+    def process(self, scorer, input_ids):
+        vocab_scores = torch.log_softmax(torch.arange(10, dtype=torch.float).repeat(4, 1), dim=-1)
+        return process(scorer, input_ids, vocab_scores, next_tokens=[[9, 8, 7, 6]] * 2, eos_token_id=1)
+
+    def test_remaining_steps(self):
+        state = ConstraintListState([PhrasalConstraint([1, 2, 3]), DisjunctiveConstraint([[4, 5, 6], [7]])])
+        self.assertEqual(state.remaining_steps(), 4)
+        state.reset([1, 2])
+        self.assertEqual(state.remaining_steps(), 2)
+
+    def test_finishes_batch_item_without_feasible_beams(self):
+        for compile_constraints in (True, False):
+            scorer = self.make_scorer([TemplateConstraint([5, 6, 7])], 4, compile_constraints=compile_constraints)
+            # the first batch item is done with the template, the second one has only 2 tokens left to start it over
+            input_ids = torch.tensor([[5, 6], [5, 6], [2, 2], [2, 2]])
+            self.process(scorer, input_ids)
+            self.assertEqual(scorer._host_done, [False, True])
+            self.assertEqual(scorer._done.tolist(), [False, True])
+            # the most likely hypothesis is kept
+            self.assertEqual([hyp.tolist() for _, hyp, _ in scorer._beam_hyps[1].beams], [[2, 2, 9]])
+
+    def test_disabled(self):
+        scorer = self.make_scorer([TemplateConstraint([5, 6, 7])], 4, prune_infeasible_beams=False)
+        self.process(scorer, torch.tensor([[5, 6], [5, 6], [2, 2], [2, 2]]))
+        self.assertEqual(scorer._host_done, [False, False])
+
+        # nor is anything pruned without `max_length`
+        self.assertFalse(self.make_scorer([TemplateConstraint([5, 6, 7])], None).prune_infeasible_beams)
+
+    def test_beam_search_with_banned_tokens(self):
+        # no_repeat_ngram_size=2 bans the tokens restarting the phrase, so that some beams run out of time
+        input_ids = torch.tensor([[3, 4, 3, 5, 3]] * 2 + [[2] * 5] * 2)
+        outputs = []
+        for compile_constraints in (True, False):
+            scorer = self.make_scorer(
+                [PhrasalConstraint([3, 4, 6]), DisjunctiveConstraint([[7], [8, 9]])], 9, compile_constraints
+            )
+            outputs.append(beam_search(scorer, input_ids, 9))
+            for sequence in outputs[-1]["sequences"]:
+                self.assertTrue(scorer.check_completes_constraints(sequence.tolist()))
+        self.assertTrue(torch.equal(outputs[0]["sequences"], outputs[1]["sequences"]))
+
+
+
+class TestConstraintEarlyStopping(unittest.TestCase):
+    def make_scorer(self, phrase, max_length, compile_constraints=True, constraint_aware_early_stopping=True):
+        scorer = make_scorer(
+            [PhrasalConstraint(phrase)],
+            max_length=max_length,
+            do_early_stopping=False,
+            compile_constraints=compile_constraints,
+            constraint_aware_early_stopping=constraint_aware_early_stopping,
+        )
+        # two finished hypotheses fulfilling the constraint, both worse than any candidate
+        for _ in range(2):
+            scorer._beam_hyps[0].add(torch.tensor([0] + phrase + [1]), -50.0)
+        return scorer
+
+    def process(self, scorer, next_tokens):
+        vocab_scores = torch.log_softmax(torch.arange(8, dtype=torch.float).repeat(2, 1), dim=-1)
+        process(scorer, torch.tensor([[0], [0]]), vocab_scores, next_tokens=[next_tokens], eos_token_id=1)
+        return scorer.is_done
+
+    def test_beams_that_can_still_fulfill_constraints_hold_batch_open(self):
+        for compile_constraints in (True, False):
+            scorer = self.make_scorer([5, 6], max_length=10, compile_constraints=compile_constraints)
+            self.assertFalse(self.process(scorer, [7, 6, 4, 3]))
+
+    def test_beams_out_of_time_dont_hold_batch_open(self):
+        for compile_constraints in (True, False):
+            # after this step, only one token is left but the phrase needs 2 or 3 more
+            scorer = self.make_scorer([5, 6, 7], max_length=3, compile_constraints=compile_constraints)
+            self.assertTrue(self.process(scorer, [7, 5, 4, 3]))
+            # neither does an eos candidate that doesn't fulfill the constraints
+            scorer = self.make_scorer([5, 6, 7], max_length=3, compile_constraints=compile_constraints)
+            self.assertTrue(self.process(scorer, [1, 7, 5, 4]))
+
+    def test_beams_fulfilling_constraints_hold_batch_open(self):
+        for compile_constraints in (True, False):
+            scorer = self.make_scorer([5], max_length=2, compile_constraints=compile_constraints)
+            self.assertFalse(self.process(scorer, [7, 5, 4, 3]))
+
+    def test_disabled(self):
+        scorer = self.make_scorer([5, 6, 7], max_length=3, constraint_aware_early_stopping=False)
+        self.assertFalse(self.process(scorer, [7, 5, 4, 3]))
+        self.assertFalse(make_scorer([PhrasalConstraint([5])]).constraint_aware_early_stopping)
+
+    def test_beam_search_with_banned_tokens(self):
+        # with -inf scored candidates around, stopping early still returns what the search finds without the rule
+        input_ids = torch.tensor([[3, 4, 3, 5, 3]] * 2 + [[2] * 5] * 2)
+        constraints = [PhrasalConstraint([3, 4, 6]), DisjunctiveConstraint([[7], [8, 9]])]
+        for compile_constraints in (True, False):
+            outputs = []
+            for constraint_aware_early_stopping in (True, False):
+                scorer = make_scorer(
+                    constraints,
+                    batch_size=2,
+                    max_length=10,
+                    do_early_stopping=False,
+                    compile_constraints=compile_constraints,
+                    constraint_aware_early_stopping=constraint_aware_early_stopping,
+                )
+                outputs.append(beam_search(scorer, input_ids, 10, eos_token_id=1))
+            self.assertTrue(torch.equal(outputs[0]["sequences"], outputs[1]["sequences"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
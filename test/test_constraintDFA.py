@@ -0,0 +1,121 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import random
+import unittest
+from unittest import mock
+import torch
+from transformers.generation.beam_constraints import (
+    BatchedConstraintListState,
+    ConstraintDFA,
+    ConstraintListState,
+    DisjunctiveConstraint,
+    OrderedConstraint,
+    OrderedConstraintJunyao,
+    PhrasalConstraint,
+    TemplateConstraint,
+)
+from transformers.generation.beam_search import ConstrainedBeamSearchScorer
+
+
+class TestConstraintDFA(unittest.TestCase):
+    def assert_matches_list_state(self, constraints, vocab_size=12, num_seqs=50, seq_len=15):
+        dfa = ConstraintDFA(constraints)
+        rng = random.Random(0)
+        sequences = torch.tensor([[rng.randrange(vocab_size) for _ in range(seq_len)] for _ in range(num_seqs)])
+
+        state_ids = torch.zeros(num_seqs, dtype=torch.int32)
+        for step in range(seq_len):
+            state_ids = dfa.step(state_ids, sequences[:, step])
+            for seq_idx in range(num_seqs):
+                state = ConstraintListState([constraint.copy() for constraint in constraints])
+                state.reset(sequences[seq_idx, : step + 1].tolist())
+                state_id = state_ids[seq_idx].item()
+                self.assertEqual(dfa.completed[state_id].item(), state.completed)
+                self.assertEqual(dfa.banks[state_id].item(), state.get_bank())
+                self.assertEqual(dfa.state_advance[state_id], state.advance())
+                self.assertEqual(dfa.get_remaining_steps(state_ids)[seq_idx].item(), state.remaining_steps())
+
+        self.assertTrue(torch.equal(dfa.initial_states(sequences), state_ids))
+
+    def test_template(self):
+        self.assert_matches_list_state([TemplateConstraint([5, None, 3])])
+
+    def test_ordered(self):
+        self.assert_matches_list_state([OrderedConstraint([5, None, 3, 7])])
+
+    def test_multiple_constraints(self):
+        self.assert_matches_list_state(
+            [PhrasalConstraint([1, 2]), DisjunctiveConstraint([[3], [4, 5]]), TemplateConstraint([None, 6])]
+        )
+
+    def test_state_dtype(self):
+        dfa = ConstraintDFA([TemplateConstraint([5, None, 3])])
+        state_ids = dfa.step(torch.zeros(4, dtype=torch.int32), torch.tensor([5, 1, 3, 5]))
+        self.assertEqual(state_ids.dtype, torch.int32)
+        self.assertEqual(dfa.transitions.shape, (dfa.num_states, 3))
+
+    def test_max_states(self):
+        with self.assertRaises(ValueError):
+            ConstraintDFA([PhrasalConstraint([1, 2, 3]), PhrasalConstraint([4, 5, 6])], max_states=3)
+
+    def test_estimate_num_states(self):
+        for constraints in (
+            [TemplateConstraint([5, None, 3])],
+            [OrderedConstraint([5, None, 3, 7]), OrderedConstraintJunyao([5, 6])],
+            [PhrasalConstraint([1, 2]), DisjunctiveConstraint([[3], [4, 5]]), TemplateConstraint([None, 6])],
+            [PhrasalConstraint([1, 2, 1]), PhrasalConstraint([1, 2]), PhrasalConstraint([2, 1]), PhrasalConstraint([1])],
+        ):
+            self.assertLessEqual(ConstraintDFA(constraints).num_states, ConstraintDFA.estimate_num_states(constraints))
+
+
+class TestCompileConstraints(unittest.TestCase):
+    def make_scorer(self, constraints):
+        return ConstrainedBeamSearchScorer(batch_size=1, num_beams=2, constraints=constraints, device="cpu")
+
+    def test_reused_across_scorers(self):
+        compiled = self.make_scorer([PhrasalConstraint([1, 2]), TemplateConstraint([None, 61])])._compiled_constraints
+        self.assertIsInstance(compiled, ConstraintDFA)
+        with mock.patch.object(ConstraintDFA, "__init__") as init:
+            scorer = self.make_scorer([PhrasalConstraint([1, 2]), TemplateConstraint([None, 61])])
+        init.assert_not_called()
+        self.assertIs(scorer._compiled_constraints, compiled)
+
+        # different constraints are compiled on their own
+        self.assertIsNot(self.make_scorer([PhrasalConstraint([1, 3])])._compiled_constraints, compiled)
+
+    def test_large_constraints_skip_dfa(self):
+        # too many combinations of progress for a `ConstraintDFA`, which is never explored
+        constraints = [DisjunctiveConstraint([[100 * i + j, 100 * i + j + 50] for j in range(40)]) for i in range(4)]
+        self.assertGreater(ConstraintDFA.estimate_num_states(constraints), 4096)
+        with mock.patch.object(ConstraintDFA, "__init__") as init:
+            compiled = self.make_scorer(constraints)._compiled_constraints
+        init.assert_not_called()
+        self.assertIsInstance(compiled, BatchedConstraintListState)
+
+    def test_too_large_constraint_not_compiled(self):
+        constraints = [DisjunctiveConstraint([[i, 5000 + i] for i in range(2100)])]
+        with mock.patch.object(ConstraintDFA, "__init__") as dfa_init, mock.patch.object(
+            BatchedConstraintListState, "__init__"
+        ) as batched_init:
+            with self.assertLogs("transformers.generation.beam_search", level="INFO"):
+                self.assertIsNone(self.make_scorer(constraints)._compiled_constraints)
+        dfa_init.assert_not_called()
+        batched_init.assert_not_called()
+
+    def test_unsupported_constraint_not_compiled(self):
+        unsupported = NotImplementedError("can't be compiled")
+        with mock.patch.object(TemplateConstraint, "state_key", side_effect=unsupported):
+            with self.assertLogs("transformers.generation.beam_search", level="INFO") as logs:
+                scorer = self.make_scorer([TemplateConstraint([None, 71])])
+        self.assertIsNone(scorer._compiled_constraints)
+        self.assertIn("can't be compiled", logs.output[0])
+
+    def test_compile_errors_not_swallowed(self):
+        constraints = [DisjunctiveConstraint([[200 * i + j, 200 * i + j + 100] for j in range(40)]) for i in range(4)]
+        with mock.patch.object(BatchedConstraintListState, "__init__", side_effect=ValueError("bug")):
+            with self.assertRaises(ValueError):
+                self.make_scorer(constraints)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import unittest
+from unittest import mock
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+from transformers.generation.beam_constraints import WILDCARD, ConstraintListState, TemplateConstraint
+from transformers.generation.beam_search import ConstrainedBeamSearchScorer
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    OrderedConstraintLogitsProcessor,
+    SimpleOrderedConstraintLogitsProcessor,
+    TemplateConstraintLogitsProcessor,
+)
+
+
+class TestTemplateConstraintLogitsProcessor(unittest.TestCase):
+    def test_masks_all_but_expected_token(self):
+        processor = TemplateConstraintLogitsProcessor([3, None, 7], vocab_size=10)
+        scores = torch.randn(4, 10)
+
+        processed = processor(None, scores.clone())
+        self.assertTrue(torch.equal(processed[:, 3], scores[:, 3]))
+        self.assertTrue(torch.isinf(processed[:, [0, 1, 2, 4, 5, 6, 7, 8, 9]]).all())
+
+        # `None` slots and positions past the template leave the scores untouched
+        self.assertTrue(torch.equal(processor(None, scores.clone()), scores))
+        self.assertEqual(processor(None, scores.clone()).argmax(-1).tolist(), [7] * 4)
+        self.assertTrue(torch.equal(processor(None, scores.clone()), scores))
+
+    def test_masks_are_built_once(self):
+        processor = TemplateConstraintLogitsProcessor([3, 5, 7], vocab_size=10)
+        processor(None, torch.randn(2, 10))
+        masks = processor._banned_masks
+        processor(None, torch.randn(2, 10))
+        self.assertIs(processor._banned_masks, masks)
+        self.assertEqual(masks.shape, (3, 10))
+
+    def make_scorer(self, template, compile_constraints=True):
+        return ConstrainedBeamSearchScorer(
+            batch_size=1,
+            num_beams=3,
+            constraints=[TemplateConstraint(template)],
+            device="cpu",
+            max_length=10,
+            compile_constraints=compile_constraints,
+        )
+
+    def expected_allowed_tokens(self, template, tokens):
+        state = ConstraintListState([TemplateConstraint(template)])
+        state.reset(tokens)
+        advance = state.advance()
+        if state.completed or advance is None or WILDCARD in advance:
+            return None
+        return sorted(advance)
+
+    def test_follows_beams_through_process(self):
+        template = [3, None, 7]
+        generator = torch.Generator().manual_seed(0)
+        for compile_constraints in (True, False):
+            scorer = self.make_scorer(template, compile_constraints=compile_constraints)
+            processor = TemplateConstraintLogitsProcessor(template, vocab_size=10, scorer=scorer)
+            input_ids = torch.zeros((3, 1), dtype=torch.long)
+            for _ in range(6):
+                scores = torch.randn(3, 10, generator=generator)
+                processed = processor(input_ids, scores)
+                for row, tokens in enumerate(input_ids.tolist()):
+                    allowed = self.expected_allowed_tokens(template, tokens)
+                    if allowed is None:
+                        self.assertTrue(torch.equal(processed[row], scores[row]))
+                    else:
+                        self.assertEqual(processed[row].isfinite().nonzero().flatten().tolist(), allowed)
+
+                # random candidates, so that the beams get reordered and end up at different points of the template
+                vocab_scores = torch.log_softmax(torch.randn(3, 10, generator=generator), dim=-1)
+                next_scores, next_tokens = vocab_scores.view(1, -1).topk(6)
+                outputs = scorer.process(
+                    input_ids,
+                    next_scores,
+                    next_tokens % 10,
+                    next_tokens // 10,
+                    vocab_scores,
+                    pad_token_id=0,
+                    eos_token_id=None,
+                )
+                input_ids = torch.cat(
+                    [input_ids[outputs["next_beam_indices"]], outputs["next_beam_tokens"].unsqueeze(-1)], dim=-1
+                )
+
+    def test_attached_to_scorer_of_generate(self):
+        torch.manual_seed(0)
+        config = GPT2Config(vocab_size=20, n_positions=16, n_embd=16, n_layer=1, n_head=2)
+        model = GPT2LMHeadModel(config).eval()
+        constraint = TemplateConstraint([5, None, 7])
+        processor = TemplateConstraintLogitsProcessor(constraint.template, vocab_size=20, constraint=constraint)
+        with mock.patch.object(
+            processor, "_beam_constraint_scores", wraps=processor._beam_constraint_scores
+        ) as beam_constraint_scores:
+            outputs = model.generate(
+                torch.tensor([[1, 2]]),
+                num_beams=3,
+                max_length=8,
+                constraints=[constraint],
+                logits_processor=LogitsProcessorList([processor]),
+                pad_token_id=0,
+            )
+        self.assertTrue(beam_constraint_scores.called)
+        self.assertEqual(outputs[0, 2:5].tolist()[::2], [5, 7])
+        # detached once the search is over
+        self.assertIsNone(processor.scorer)
+
+    def test_ignores_scorer_of_other_search(self):
+        constraint = TemplateConstraint([3, 5])
+        processor = TemplateConstraintLogitsProcessor(constraint.template, vocab_size=10, constraint=constraint)
+        scorer = ConstrainedBeamSearchScorer(batch_size=1, num_beams=3, constraints=[constraint], device="cpu")
+        self.assertIs(processor.scorer, scorer)
+
+        # 2 rows can't be the 3 beams of the scorer, so the template is followed by position
+        with mock.patch.object(processor, "_beam_constraint_scores") as beam_constraint_scores:
+            processed = processor(torch.zeros((2, 1), dtype=torch.long), torch.zeros(2, 10))
+        beam_constraint_scores.assert_not_called()
+        self.assertEqual(processed.isfinite().nonzero()[:, 1].tolist(), [3, 3])
+
+    def test_boost(self):
+        for compile_constraints in (True, False):
+            scorer = self.make_scorer([3, 5], compile_constraints=compile_constraints)
+            processor = TemplateConstraintLogitsProcessor([3, 5], vocab_size=10, scorer=scorer, boost=5.0)
+            processed = processor(torch.zeros((3, 1), dtype=torch.long), torch.zeros(3, 10))
+            self.assertEqual(processed[:, 3].tolist(), [5.0] * 3)
+            self.assertEqual(processed.sum().item(), 15.0)
+
+
+    def test_scores_left_unchanged(self):
+        scorer = self.make_scorer([3, 5])
+        processors = [
+            TemplateConstraintLogitsProcessor([3, 5], vocab_size=10),
+            TemplateConstraintLogitsProcessor([3, 5], vocab_size=10, scorer=scorer),
+            TemplateConstraintLogitsProcessor([3, 5], vocab_size=10, scorer=scorer, boost=5.0),
+            SimpleOrderedConstraintLogitsProcessor([3, 5], vocab_size=10),
+            OrderedConstraintLogitsProcessor([3, 5]),
+        ]
+        for processor in processors:
+            scores = torch.randn(3, 10)
+            original = scores.clone()
+            processed = processor(torch.zeros((3, 1), dtype=torch.long), scores)
+            self.assertFalse(torch.equal(processed, original))
+            self.assertTrue(torch.equal(scores, original))
+
+
+class TestSimpleOrderedConstraintLogitsProcessor(unittest.TestCase):
+    def test_masks_by_sequence_length(self):
+        processor = SimpleOrderedConstraintLogitsProcessor([None, 2, None, 5], vocab_size=10)
+        scores = torch.randn(3, 10)
+
+        self.assertEqual(processor(torch.zeros((3, 1), dtype=torch.long), scores.clone()).argmax(-1).tolist(), [2] * 3)
+        self.assertTrue(torch.equal(processor(torch.zeros((3, 2), dtype=torch.long), scores.clone()), scores))
+        self.assertEqual(processor(torch.zeros((3, 3), dtype=torch.long), scores.clone()).argmax(-1).tolist(), [5] * 3)
+        self.assertTrue(torch.equal(processor(torch.zeros((3, 4), dtype=torch.long), scores.clone()), scores))
+
+
+class TestOrderedConstraintLogitsProcessor(unittest.TestCase):
+    def test_rows_are_tracked_separately(self):
+        processor = OrderedConstraintLogitsProcessor([4, 6])
+        scores = torch.zeros(2, 10)
+
+        processed = processor(torch.tensor([[0, 4], [0, 1]]), scores.clone())
+        self.assertEqual(processor.positions.tolist(), [1, 0])
+        # the row that just matched is left alone, the other one is pushed towards its expected token
+        self.assertEqual(processed[0].tolist(), [0.0] * 10)
+        self.assertEqual(processed[1, 4].item(), 5.0)
+
+        processed = processor(torch.tensor([[0, 4, 2], [0, 1, 4]]), scores.clone())
+        self.assertEqual(processor.positions.tolist(), [1, 1])
+        self.assertEqual(processed[:, 6].tolist(), [5.0, 0.0])
+
+    def test_follows_reordered_beams(self):
+        processor = OrderedConstraintLogitsProcessor([4, 6, 8])
+        processor(torch.tensor([[0, 4], [0, 1], [0, 2]]), torch.zeros(3, 10))
+
+        # every new row extends the previous second row, except for the last one
+        processor(torch.tensor([[0, 1, 4], [0, 1, 3], [0, 4, 6]]), torch.zeros(3, 10))
+        self.assertEqual(processor.positions.tolist(), [1, 0, 2])
+
+    def test_rows_without_parent_start_over(self):
+        processor = OrderedConstraintLogitsProcessor([4, 6, 8])
+        processor(torch.tensor([[0, 4], [4, 6]]), torch.zeros(2, 10))
+        self.assertEqual(processor.positions.tolist(), [1, 0])
+
+        # reused on new sequences of the next length, whose first row extends no previous row
+        processor(torch.tensor([[5, 5, 6], [4, 6, 8]]), torch.zeros(2, 10))
+        self.assertEqual(processor.positions.tolist(), [0, 0])
+
+    def test_completed(self):
+        processor = OrderedConstraintLogitsProcessor([4])
+        processor(torch.tensor([[4]]), torch.zeros(1, 10))
+        scores = torch.randn(1, 10)
+        self.assertTrue(torch.equal(processor(torch.tensor([[4, 1]]), scores.clone()), scores))
+
+
+if __name__ == "__main__":
+    unittest.main()
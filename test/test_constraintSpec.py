@@ -0,0 +1,108 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import copy
+import pickle
+import unittest
+from unittest import mock
+from transformers.generation.beam_constraints import (
+    ConstraintSpec,
+    DisjunctiveConstraint,
+    OrderedConstraint,
+    OrderedConstraintJunyao,
+    PhrasalConstraint,
+    TemplateConstraint,
+)
+
+
+class TestConstraintSpec(unittest.TestCase):
+    def make_constraints(self):
+        return [
+            PhrasalConstraint([1, 2, 3]),
+            DisjunctiveConstraint([[1, 2], [3]]),
+            TemplateConstraint([1, None, 3]),
+            OrderedConstraint([1, None, 3]),
+            OrderedConstraintJunyao([1, 2, 3]),
+        ]
+
+    def test_copies_share_spec(self):
+        for constraint in self.make_constraints():
+            constraint.update(1)
+            for stateful in (False, True):
+                copied = constraint.copy(stateful=stateful)
+                self.assertIs(copied.spec, constraint.spec)
+                self.assertFalse(hasattr(copied, "__dict__"))
+                self.assertEqual(copied.state_key() == constraint.state_key(), stateful)
+
+            copied = constraint.copy(stateful=True)
+            copied.update(2)
+            # progressing a copy leaves the original where it was
+            self.assertEqual(constraint.state_key(), constraint.copy(stateful=True).state_key())
+            self.assertNotEqual(copied.state_key(), constraint.state_key())
+
+    def test_copy_skips_validation(self):
+        constraint = TemplateConstraint([1, None, 3])
+        with mock.patch.object(TemplateConstraint, "test") as test:
+            constraint.copy()
+            constraint.copy(stateful=True)
+        test.assert_not_called()
+
+    def test_validation_cached_per_spec(self):
+        with mock.patch.object(OrderedConstraint, "test") as test:
+            OrderedConstraint([11, None, 13, 17])
+            OrderedConstraint([11, None, 13, 17])
+            OrderedConstraint([11, None, 13, 17], vocab_length=10)
+            self.assertEqual(test.call_count, 1)
+            OrderedConstraint([11, None, 13, 19])
+        self.assertEqual(test.call_count, 2)
+
+        # same content but a different class
+        with mock.patch.object(TemplateConstraint, "test") as test:
+            TemplateConstraint([11, None, 13, 17])
+        test.assert_called_once()
+
+    def test_failed_validation_not_cached(self):
+        class BrokenTemplateConstraint(TemplateConstraint):
+            __slots__ = ()
+
+            def remaining(self):
+                return 1
+
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                BrokenTemplateConstraint([21, None])
+
+    def test_spec_is_immutable(self):
+        spec = ConstraintSpec([1, 2], vocab_length=10)
+        self.assertEqual((spec.key, spec.seqlen, spec.vocab_length), ((1, 2), 2, 10))
+        with self.assertRaises(AttributeError):
+            spec.seqlen = 3
+
+    def test_deepcopy_and_pickle(self):
+        for constraint in self.make_constraints():
+            constraint.update(1)
+            deep_copied = copy.deepcopy(constraint)
+            self.assertIs(deep_copied.spec, constraint.spec)
+            self.assertEqual(deep_copied.state_key(), constraint.state_key())
+
+            unpickled = pickle.loads(pickle.dumps(constraint))
+            self.assertIs(type(unpickled.spec), type(constraint.spec))
+            self.assertEqual(unpickled.state_key(), constraint.state_key())
+            with self.assertRaises(AttributeError):
+                unpickled.spec.seqlen = 0
+            # both keep tracking progress like the original
+            for copied in (deep_copied, unpickled):
+                copied.update(2)
+                reference = constraint.copy(stateful=True)
+                reference.update(2)
+                self.assertEqual(copied.state_key(), reference.state_key())
+
+    def test_spec_attributes(self):
+        constraint = OrderedConstraint([5, None], vocab_length=10)
+        self.assertEqual(constraint.ordered_token_ids, [5, None])
+        self.assertEqual(constraint.seqlen, 2)
+        self.assertEqual(constraint.vocab_length, 10)
+        self.assertEqual(DisjunctiveConstraint([[1, 2], [3]]).seqlen, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import unittest
+import torch
+from transformers.generation.beam_constraints import DisjunctiveConstraint, DisjunctiveTrie
+
+
+class TestDisjunctiveTrie(unittest.TestCase):
+    def test_layout(self):
+        trie = DisjunctiveTrie([[1, 2, 3], [1, 4], [5]])
+        # root -> {1, 5}, 1 -> {2, 4}, 2 -> {3}
+        self.assertEqual(trie.num_nodes, 6)
+        self.assertEqual(trie.offsets.tolist(), [0, 2, 4, 4, 5, 5, 5])
+        self.assertEqual(trie.child_token_ids.tolist(), [1, 5, 2, 4, 3])
+        self.assertEqual(trie.child_node_ids.tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(trie.depths.tolist(), [0, 1, 1, 2, 2, 3])
+        self.assertEqual(trie.min_heights.tolist(), [1, 1, 0, 1, 0, 0])
+
+    def test_next_tokens(self):
+        trie = DisjunctiveTrie([[1, 2, 3], [1, 4], [5]])
+        self.assertEqual(trie.next_tokens([]), [1, 5])
+        self.assertEqual(trie.next_tokens([1]), [2, 4])
+        self.assertTrue(trie.reached_leaf([1, 4]))
+        self.assertFalse(trie.reached_leaf([1, 2]))
+        self.assertIsNone(trie.next_node(0, 2))
+
+    def test_subsets(self):
+        with self.assertRaises(ValueError):
+            DisjunctiveTrie([[1, 2], [1, 2, 3]])
+        with self.assertRaises(ValueError):
+            DisjunctiveTrie([[1, 2], [1, 2]])
+
+    def test_constraint(self):
+        constraint = DisjunctiveConstraint([[1, 2, 3], [1, 4]])
+        self.assertEqual(constraint.advance(), [1])
+        self.assertEqual(constraint.update(1), (True, False, False))
+        self.assertEqual(constraint.advance(), [2, 4])
+        self.assertEqual(constraint.remaining(), 2)
+        self.assertEqual(constraint.min_remaining(), 1)
+
+        copied = constraint.copy(stateful=True)
+        self.assertIs(copied.trie, constraint.trie)
+        self.assertEqual(copied.update(4), (True, True, False))
+        self.assertEqual(copied.remaining(), 0)
+        self.assertFalse(constraint.completed)
+        self.assertEqual(constraint.copy().advance(), [1])
+
+        self.assertEqual(constraint.update(5), (False, False, True))
+        self.assertEqual(constraint.advance(), [1])
+
+    def test_next_token_tensors(self):
+        trie = DisjunctiveTrie([[1, 2, 3], [1, 4], [5]])
+        self.assertEqual(trie.next_token_ids(1).tolist(), [2, 4])
+        self.assertIs(trie.next_token_ids(1), trie.next_token_ids(1))
+        self.assertEqual(trie.next_token_mask(0, 6).tolist(), [False, True, False, False, False, True])
+        self.assertEqual(trie.next_token_masks([1, 3], 6).nonzero().tolist(), [[0, 2], [0, 4], [1, 3]])
+
+        constraint = DisjunctiveConstraint([[1, 2, 3], [1, 4]])
+        constraint.update(1)
+        scores = torch.zeros(6).masked_fill_(~constraint.advance_mask(6), -float("inf"))
+        self.assertEqual(scores.isfinite().nonzero().flatten().tolist(), [2, 4])
+
+    def test_tensor_cache_size(self):
+        trie = DisjunctiveTrie([[1, 2, 3], [1, 4], [5]], cache_size=2)
+        first = trie.next_token_ids(0)
+        trie.next_token_ids(1)
+        trie.next_token_ids(0)
+        trie.next_token_ids(2)
+        # node 1 was the least recently used one
+        self.assertIs(trie.next_token_ids(0), first)
+        self.assertEqual(len(trie._tensor_cache), 2)
+        self.assertNotIn(("ids", 1, torch.device("cpu")), trie._tensor_cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import unittest
+from unittest import mock
+import torch
+from transformers.generation import logits_process
+from transformers.generation.logits_process import (
+    ForcedEOSTokenLogitsProcessor,
+    LogitsProcessor,
+    LogitsProcessorList,
+    MinLengthLogitsProcessor,
+    NoRepeatNGramLogitsProcessor,
+    OrderedConstraintLogitsProcessor,
+    SuppressTokensLogitsProcessor,
+    TemperatureLogitsWarper,
+    TemplateConstraintLogitsProcessor,
+)
+
+
+class KwargsLogitsProcessor(LogitsProcessor):
+    def __call__(self, input_ids, scores, offset):
+        return scores + offset
+
+
+class RecordingLogitsProcessor(LogitsProcessor):
+    is_inplace = True
+
+    def __call__(self, input_ids, scores):
+        return self.process_inplace(input_ids, scores.clone())
+
+    def process_inplace(self, input_ids, scores):
+        self.seen = scores
+        return scores
+
+
+class TestLogitsProcessorList(unittest.TestCase):
+    def make_processors(self):
+        return [
+            TemperatureLogitsWarper(0.5),
+            MinLengthLogitsProcessor(5, eos_token_id=1),
+            NoRepeatNGramLogitsProcessor(2),
+            SuppressTokensLogitsProcessor([3]),
+            TemplateConstraintLogitsProcessor([None, None, None, 4], vocab_size=8),
+            OrderedConstraintLogitsProcessor([6]),
+            ForcedEOSTokenLogitsProcessor(5, eos_token_id=2),
+        ]
+
+    def test_fused_matches_unfused(self):
+        input_ids = torch.tensor([[0, 5, 0, 5], [1, 2, 1, 7]])
+        scores = torch.randn(2, 8)
+        original = scores.clone()
+        expected = LogitsProcessorList(self.make_processors())(input_ids, scores)
+        self.assertTrue(torch.equal(scores, original))
+        processors = LogitsProcessorList(self.make_processors(), fused=True)
+        torch.testing.assert_close(processors(input_ids, scores), expected)
+        # the scores given to the list are left as they were
+        self.assertTrue(torch.equal(scores, original))
+
+    def test_fused_shares_one_buffer(self):
+        processors = LogitsProcessorList(
+            [RecordingLogitsProcessor(), TemperatureLogitsWarper(0.5), RecordingLogitsProcessor()], fused=True
+        )
+        scores = torch.randn(2, 8)
+        processed = processors(torch.zeros(2, 2, dtype=torch.long), scores)
+        # one copy of the scores, written by every processor in turn
+        self.assertIsNot(processors[0].seen, scores)
+        self.assertIs(processors[2].seen, processors[0].seen)
+        self.assertIs(processed, processors[0].seen)
+        torch.testing.assert_close(processed, scores / 0.5)
+
+    def test_process_inplace(self):
+        input_ids = torch.tensor([[0, 5, 0, 5], [1, 2, 1, 7]])
+        for processor, unfused in zip(self.make_processors(), self.make_processors()):
+            if not processor.is_inplace:
+                continue
+            scores = torch.randn(2, 8)
+            expected = unfused(input_ids, scores)
+            self.assertIs(processor.process_inplace(input_ids, scores), scores)
+            torch.testing.assert_close(scores, expected)
+
+    def test_signature_resolved_once(self):
+        processors = LogitsProcessorList([TemperatureLogitsWarper(0.5), KwargsLogitsProcessor()])
+        with mock.patch.object(
+            logits_process.inspect, "signature", wraps=logits_process.inspect.signature
+        ) as signature:
+            for _ in range(3):
+                processed = processors(torch.zeros(1, 2, dtype=torch.long), torch.ones(1, 4), offset=1.0)
+        self.assertEqual(signature.call_count, 2)
+        self.assertEqual(processed.tolist(), [[3.0, 3.0, 3.0, 3.0]])
+
+    def test_missing_kwargs(self):
+        processors = LogitsProcessorList([KwargsLogitsProcessor()])
+        with self.assertRaises(ValueError):
+            processors(torch.zeros(1, 2, dtype=torch.long), torch.ones(1, 4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import random
+import unittest
+import torch
+from transformers.generation.logits_process import (
+    NoRepeatNGramLogitsProcessor,
+    _calc_banned_ngram_mask,
+    _calc_banned_ngram_tokens,
+)
+
+
+class TestNoRepeatNGram(unittest.TestCase):
+    def expected_scores(self, ngram_size, input_ids, scores):
+        expected = scores.clone()
+        banned = _calc_banned_ngram_tokens(ngram_size, input_ids, input_ids.shape[0], input_ids.shape[-1])
+        for i, banned_tokens in enumerate(banned):
+            expected[i, banned_tokens] = -float("inf")
+        return expected
+
+    def assert_matches_from_scratch(
+        self, ngram_size, num_rows=6, vocab_size=5, num_steps=20, seed=0, device_native=False
+    ):
+        rng = random.Random(seed)
+        processor = NoRepeatNGramLogitsProcessor(ngram_size, device_native=device_native)
+        input_ids = torch.tensor([[rng.randrange(vocab_size) for _ in range(2)] for _ in range(num_rows)])
+        for _ in range(num_steps):
+            scores = torch.randn(num_rows, vocab_size)
+            self.assertTrue(
+                torch.equal(processor(input_ids, scores), self.expected_scores(ngram_size, input_ids, scores))
+            )
+            # beams are reordered and extended like in beam search, several of them sharing the same parent
+            beam_idx = torch.tensor([rng.randrange(num_rows) for _ in range(num_rows)])
+            next_tokens = torch.tensor([[rng.randrange(vocab_size)] for _ in range(num_rows)])
+            input_ids = torch.cat([input_ids[beam_idx], next_tokens], dim=-1)
+
+    def test_bigrams(self):
+        self.assert_matches_from_scratch(2)
+
+    def test_other_sizes(self):
+        for ngram_size in (1, 3, 4):
+            self.assert_matches_from_scratch(ngram_size, seed=ngram_size)
+
+    def test_device_native(self):
+        for ngram_size in (1, 2, 3, 4):
+            self.assert_matches_from_scratch(ngram_size, seed=ngram_size, device_native=True)
+
+    def test_banned_ngram_mask(self):
+        input_ids = torch.tensor([[1, 2, 1, 3, 1], [3, 3, 3, 0, 0]])
+        banned = _calc_banned_ngram_mask(2, input_ids, 4)
+        self.assertEqual(banned.nonzero().tolist(), [[0, 2], [0, 3], [1, 0]])
+        # not even one n-gram generated yet
+        self.assertFalse(_calc_banned_ngram_mask(3, input_ids[:, :2], 4).any())
+
+    def test_tables_updated_incrementally(self):
+        processor = NoRepeatNGramLogitsProcessor(2)
+        processor(torch.tensor([[1, 2, 1], [3, 3, 3]]), torch.zeros(2, 4))
+        first_table = processor._ngram_tables[0]
+        # both new rows extend the first one, which gives its table to the first of them
+        scores = processor(torch.tensor([[1, 2, 1, 2], [1, 2, 1, 3]]), torch.zeros(2, 4))
+        self.assertIs(processor._ngram_tables[0], first_table)
+        self.assertEqual(processor._ngram_tables[0], {(1,): (2, 2), (2,): (1,)})
+        self.assertEqual(processor._ngram_tables[1], {(1,): (2, 3), (2,): (1,)})
+        self.assertEqual(scores.isinf().nonzero().tolist(), [[0, 1]])
+
+    def test_rebuilds_on_new_sequences(self):
+        processor = NoRepeatNGramLogitsProcessor(2)
+        processor(torch.tensor([[1, 2, 1]]), torch.zeros(1, 4))
+        scores = processor(torch.tensor([[3, 2, 3, 2]]), torch.zeros(1, 4))
+        self.assertEqual(scores.isinf().nonzero().tolist(), [[0, 3]])
+
+
+if __name__ == "__main__":
+    unittest.main()
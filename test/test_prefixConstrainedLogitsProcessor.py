@@ -0,0 +1,61 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import unittest
+import torch
+from transformers.generation.logits_process import PrefixConstrainedLogitsProcessor
+
+
+def prefix_allowed_tokens_fn(batch_id, input_ids):
+    # the token following the last one, and the batch ID
+    return [(input_ids[-1].item() + 1) % 6, batch_id]
+
+
+class TestPrefixConstrainedLogitsProcessor(unittest.TestCase):
+    def setUp(self):
+        self.input_ids = torch.tensor([[0, 1], [0, 4], [1, 5], [1, 1]])
+        self.scores = torch.randn(4, 6)
+        self.expected = PrefixConstrainedLogitsProcessor(prefix_allowed_tokens_fn, 2)(self.input_ids, self.scores)
+
+    def test_per_hypothesis(self):
+        allowed = self.expected.isfinite().nonzero().tolist()
+        self.assertEqual(allowed, [[0, 0], [0, 2], [1, 0], [1, 5], [2, 0], [2, 1], [3, 1], [3, 2]])
+        self.assertTrue(torch.equal(self.expected[0, [0, 2]], self.scores[0, [0, 2]]))
+
+    def test_batched_index(self):
+        def batched_fn(batch_ids, input_ids):
+            allowed = torch.stack([(input_ids[:, -1] + 1) % 6, batch_ids], dim=-1)
+            # padding with a negative value
+            return torch.cat([allowed, torch.full_like(batch_ids, -1).unsqueeze(-1)], dim=-1)
+
+        processor = PrefixConstrainedLogitsProcessor(batched_fn, 2, batched=True)
+        self.assertTrue(torch.equal(processor(self.input_ids, self.scores), self.expected))
+
+    def test_batched_mask(self):
+        def batched_fn(batch_ids, input_ids):
+            allowed = torch.zeros(input_ids.shape[0], 6, dtype=torch.bool)
+            allowed[torch.arange(input_ids.shape[0]), (input_ids[:, -1] + 1) % 6] = True
+            allowed[torch.arange(input_ids.shape[0]), batch_ids] = True
+            return allowed
+
+        # declared on the function, as it would be through `generate`
+        batched_fn.batched = True
+        processor = PrefixConstrainedLogitsProcessor(batched_fn, 2)
+        self.assertTrue(torch.equal(processor(self.input_ids, self.scores), self.expected))
+        # the buffer is reused on the next step
+        banned_tokens = processor._banned_tokens
+        processor(self.input_ids, self.scores)
+        self.assertIs(processor._banned_tokens, banned_tokens)
+
+    def test_unsatisfiable(self):
+        with self.assertRaises(ValueError):
+            PrefixConstrainedLogitsProcessor(lambda batch_id, input_ids: [], 2)(self.input_ids, self.scores)
+
+        def batched_fn(batch_ids, input_ids):
+            return torch.full((input_ids.shape[0], 2), -1)
+
+        with self.assertRaises(ValueError):
+            PrefixConstrainedLogitsProcessor(batched_fn, 2, batched=True)(self.input_ids, self.scores)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import unittest
+import numpy as np
+import torch
+from transformers.generation.beam_search import select_by_bank
+
+
+def select_by_bank_reference(banks, scores, num_beams):
+    # the per-batch-item selection `step_sentence_constraint` used to run on the host
+    zipped = banks * 100 + scores
+    indices = zipped.sort(descending=True).indices
+    sorted_banks = banks[indices]
+
+    counter = -1
+    cur_bank = sorted_banks[0]
+    increments = []
+    for bank in sorted_banks:
+        if bank == cur_bank:
+            counter += 1
+        else:
+            counter = 0
+            cur_bank = bank
+        increments.append(counter)
+    rearrangers = torch.tensor(np.argsort(increments, kind="mergesort"))
+
+    return indices[rearrangers][:num_beams]
+
+
+class TestSelectByBank(unittest.TestCase):
+    def test_matches_reference(self):
+        generator = torch.Generator().manual_seed(0)
+        for num_candidates in (4, 7, 12):
+            banks = torch.randint(0, 4, (5, num_candidates), generator=generator)
+            scores = -torch.rand((5, num_candidates), generator=generator) * 10
+            is_valid = torch.ones_like(banks, dtype=torch.bool)
+            selected = select_by_bank(banks, scores, is_valid, 4)
+            for row in range(5):
+                expected = select_by_bank_reference(banks[row], scores[row], 4)
+                self.assertEqual(selected[row].tolist(), expected.tolist())
+
+    def test_padding_is_never_selected(self):
+        banks = torch.tensor([[0, 2, 1, 0, 0], [1, 0, 0, 0, 0]])
+        scores = torch.tensor([[-1.0, -3.0, -2.0, -float("inf"), -float("inf")], [-1.0, -2.0, -4.0, -0.5, -0.1]])
+        is_valid = torch.tensor([[True, True, True, False, False], [True, True, True, True, True]])
+        selected = select_by_bank(banks, scores, is_valid, 3)
+        self.assertEqual(sorted(selected[0].tolist()), [0, 1, 2])
+        self.assertEqual(selected[1].tolist(), [0, 4, 3])
+
+    def test_rows_are_independent(self):
+        banks = torch.tensor([[0, 1, 2, 0], [2, 2, 2, 2]])
+        scores = torch.tensor([[-1.0, -2.0, -3.0, -0.5], [-1.0, -2.0, -3.0, -0.5]])
+        is_valid = torch.ones_like(banks, dtype=torch.bool)
+        selected = select_by_bank(banks, scores, is_valid, 2)
+        self.assertEqual(selected[0].tolist(), [2, 1])
+        self.assertEqual(selected[1].tolist(), [3, 0])
+
+    def test_demoted_selected_last(self):
+        banks = torch.tensor([[2, 1, 0, 0, 1]])
+        scores = torch.tensor([[-1.0, -2.0, -0.5, -0.1, -3.0]])
+        is_valid = torch.tensor([[True, True, True, True, False]])
+        is_demoted = torch.tensor([[True, False, False, True, False]])
+        selected = select_by_bank(banks, scores, is_valid, 4, is_demoted=is_demoted)
+        # the others round-robin, then the demoted ones round-robin, and only then the padding
+        self.assertEqual(selected[0].tolist(), [1, 2, 0, 3])
+
+        # without demoted hypotheses, the selection is unchanged
+        no_demoted = torch.zeros_like(is_demoted)
+        self.assertEqual(
+            select_by_bank(banks, scores, is_valid, 4, is_demoted=no_demoted).tolist(),
+            select_by_bank(banks, scores, is_valid, 4).tolist(),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
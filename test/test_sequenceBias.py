@@ -0,0 +1,60 @@
+import sys
+sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")
+import random
+import unittest
+import torch
+from transformers.generation.logits_process import NoBadWordsLogitsProcessor, SequenceBiasLogitsProcessor
+
+
+def expected_scores(sequence_bias, input_ids, scores):
+    """Matches every biased sequence against every hypothesis, one by one."""
+    expected = scores.clone()
+    for row, tokens in enumerate(input_ids.tolist()):
+        for sequence_ids, bias in sequence_bias.items():
+            prefix = list(sequence_ids[:-1])
+            # sequences longer than the context are left out
+            if len(sequence_ids) <= len(tokens) and tokens[len(tokens) - len(prefix) :] == prefix:
+                expected[row, sequence_ids[-1]] += bias
+    return expected
+
+
+class TestSequenceBias(unittest.TestCase):
+    def test_matches_sequence_by_sequence(self):
+        rng = random.Random(0)
+        vocab_size = 6
+        # overlapping sequences sharing prefixes and suffixes, so that failure links are taken
+        sequence_bias = {}
+        for _ in range(40):
+            sequence_ids = tuple(rng.randrange(vocab_size) for _ in range(rng.randint(1, 5)))
+            sequence_bias[sequence_ids] = float(rng.randint(-3, 3))
+        processor = SequenceBiasLogitsProcessor(sequence_bias)
+
+        for seq_len in range(1, 9):
+            input_ids = torch.tensor([[rng.randrange(vocab_size) for _ in range(seq_len)] for _ in range(20)])
+            scores = torch.zeros(20, vocab_size)
+            torch.testing.assert_close(
+                processor(input_ids, scores), expected_scores(sequence_bias, input_ids, scores)
+            )
+
+    def test_automaton_states(self):
+        processor = SequenceBiasLogitsProcessor([[[1, 2, 3], 1.0], [[2, 4], 2.0], [[5], -1.0]])
+        processor(torch.tensor([[0]]), torch.zeros(1, 6))
+        automaton = processor.automaton
+        # prefixes (1, 2) and (2,) plus the root
+        self.assertEqual((automaton.num_states, automaton.max_depth), (4, 2))
+        states = automaton.get_states(torch.tensor([[0, 1, 2], [1, 2, 2], [0, 0, 1]]))
+        self.assertEqual(automaton.depths[states].tolist(), [2, 1, 1])
+
+        scores = processor(torch.tensor([[0, 1, 2], [3, 3, 2], [0, 0, 0]]), torch.zeros(3, 6))
+        self.assertEqual(scores.tolist()[0], [0.0, 0.0, 0.0, 1.0, 2.0, -1.0])
+        self.assertEqual(scores.tolist()[1], [0.0, 0.0, 0.0, 0.0, 2.0, -1.0])
+        self.assertEqual(scores.tolist()[2], [0.0, 0.0, 0.0, 0.0, 0.0, -1.0])
+
+    def test_bad_words(self):
+        processor = NoBadWordsLogitsProcessor([[1, 2], [3, 1, 4], [5]], eos_token_id=5)
+        scores = processor(torch.tensor([[0, 3, 1], [1, 1, 1]]), torch.zeros(2, 6))
+        self.assertEqual(scores.isinf().nonzero().tolist(), [[0, 2], [0, 4], [1, 2]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,7 +2,7 @@ import sys
 sys.path.insert(0, "/home/rg3637/hpml-assign2/hpml-project/transformers/src")  
 import unittest
 import torch
-from transformers.generation.beam_constraints import Constraint, TemplateConstraint
+from transformers.generation.beam_constraints import WILDCARD, Constraint, TemplateConstraint
 from typing import List, Optional
 from transformers.generation.beam_constraints import ConstraintListState
 from transformers.testing_utils import require_torch
@@ -22,10 +22,18 @@ class TestTemplateConstraint(unittest.TestCase):
         constraint = TemplateConstraint(template)
         self.assertEqual(constraint.advance(), 5)
         constraint.position = 1
-        self.assertIsNone(constraint.advance())
+        self.assertIs(constraint.advance(), WILDCARD)
         constraint.position = 2
         self.assertEqual(constraint.advance(), 3)
     
+    def test_list_state_advance_wildcard(self):
+        state = ConstraintListState([TemplateConstraint([None, 3])])
+        self.assertEqual(state.advance(), [WILDCARD])
+        state.add(42)
+        self.assertEqual(state.advance(), [3])
+        state.add(3)
+        self.assertTrue(state.completed)
+
     def test_advance_after_completion(self):
         template = [5]
         constraint = TemplateConstraint(template)